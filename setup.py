@@ -6,7 +6,7 @@
 
 from setuptools import setup, find_packages
 
-version = "1.0.1"
+version = "1.0.2"
 
 setup(
     name="senaite.sampleimporter",
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""Process-wide description of the AnalysisRequest schema fields that the
+importer needs: name, type, allowed_types, multiValued and required.
+
+The schema is read from an AnalysisRequest instance that is created in
+memory and never added to the site, so no portal_factory object is built.
+Schema extenders add fields per instance, so the description is rebuilt
+whenever the set of extender and modifier adapters registered for the
+AnalysisRequest class changes. The adapters are looked up in the registry,
+no instance is created for that.
+"""
+
+import threading
+
+from archetypes.schemaextender.interfaces import ISchemaExtender
+from archetypes.schemaextender.interfaces import ISchemaModifier
+from bika.lims.content.analysisrequest import AnalysisRequest
+from zope.component import getSiteManager
+from zope.interface import implementedBy
+
+from senaite.sampleimporter.catalogs import get_portal
+
+_schemas = {}
+_lock = threading.Lock()
+
+
+class FieldDescriptor(object):
+    """The attributes of an AR schema field used by the importer
+    """
+    __slots__ = ('name', 'type', 'allowed_types', 'multiValued', 'required')
+
+    def __init__(self, field):
+        self.name = field.getName()
+        self.type = field.type
+        allowed_types = getattr(field, 'allowed_types', None) or ()
+        if type(allowed_types) not in (list, tuple):
+            allowed_types = (allowed_types,)
+        self.allowed_types = tuple(allowed_types)
+        self.multiValued = bool(getattr(field, 'multiValued', False))
+        self.required = bool(getattr(field, 'required', False))
+
+
+class SchemaDescriptor(object):
+    """Read-only mapping of field name to FieldDescriptor, it can be used
+    where the importer used the AR schema
+    """
+
+    def __init__(self, schema):
+        self.fields = dict((field.getName(), FieldDescriptor(field))
+                           for field in schema.fields())
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def __getitem__(self, name):
+        return self.fields[name]
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def keys(self):
+        return self.fields.keys()
+
+
+def get_extender_signature(context):
+    """Returns the names and factories of the schema extender and modifier
+    adapters registered for the AnalysisRequest class in the site of the
+    context
+    """
+    adapters = getSiteManager(context).adapters
+    required = (implementedBy(AnalysisRequest),)
+    signature = []
+    for interface in (ISchemaExtender, ISchemaModifier):
+        for name, factory in adapters.lookupAll(required, interface):
+            signature.append((name, getattr(factory, '__module__', None),
+                              getattr(factory, '__name__', repr(factory))))
+    return tuple(sorted(signature))
+
+
+def get_ar_schema(context):
+    """Returns the SchemaDescriptor of the AnalysisRequest schema of the
+    site of the context
+    """
+    site = get_portal(context)
+    key = '/'.join(site.getPhysicalPath())
+    signature = get_extender_signature(site)
+    cached = _schemas.get(key)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    instance = AnalysisRequest('ar_schema').__of__(context)
+    descriptor = SchemaDescriptor(instance.Schema())
+    with _lock:
+        _schemas[key] = (signature, descriptor)
+    return descriptor
@@ -19,6 +19,7 @@
 # Some rights reserved, see README and LICENSE.
 
 import os
+from itertools import islice
 from bika.lims import api
 from bika.lims import bikaMessageFactory as _
 from bika.lims.browser import BrowserView, ulocalized_time
@@ -35,6 +36,8 @@ from Products.CMFCore.utils import getToolByName
 from Products.CMFCore.WorkflowCore import WorkflowException
 from Products.CMFPlone.utils import _createObjectByType
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
+from senaite.sampleimporter.reader import READ_ERRORS
+from senaite.sampleimporter.reader import iter_rows
 from zope.interface import alsoProvides
 from zope.interface import implements
 
@@ -187,13 +190,20 @@ class ClientSampleImportAddView(BrowserView):
         if form.get('submitted'):
             # Validate form submission
             csvfile = form.get('csvfile')
-            data = csvfile.read()
-            lines = data.splitlines()
-            filename = csvfile.filename
             if not csvfile:
                 addStatusMessage(request, _("No file selected"))
                 return self.template()
+            filename = csvfile.filename
 
+            # Only peek at the first lines, the upload is streamed into the
+            # blob as it is. Workbooks and compressed files are stored as
+            # uploaded too, and decompressed while the file is parsed
+            try:
+                lines = list(islice(iter_rows(csvfile), 3))
+            except READ_ERRORS:
+                addStatusMessage(request, _("The file can not be read"))
+                return self.template()
+            csvfile.seek(0)
             if len(lines) < 3:
                 addStatusMessage(request, _("Too few lines in CSV file"))
                 return self.template()
@@ -202,7 +212,7 @@ class ClientSampleImportAddView(BrowserView):
             sampleimport = _createObjectByType("SampleImport", self.context, tmpID())
             sampleimport.processForm()
             sampleimport.setTitle(sampleimport.getId())
-            sampleimport.schema['OriginalFile'].set(sampleimport, data)
+            sampleimport.setOriginalFile(csvfile)
 
             # Save all fields from the file into the sampleimport schema
             sampleimport.save_header_data()
@@ -239,3 +249,17 @@ class ClientSampleImportAddView(BrowserView):
             if not existing:
                 return newname
             nr += 1
+
+
+class SampleImportResumeView(BrowserView):
+    """Queue the rows of an import that stopped before all were created
+    """
+
+    def __call__(self):
+        if self.context.can_resume_import():
+            self.context.resume_import()
+            addStatusMessage(self.request, _("Import resumed"))
+        else:
+            addStatusMessage(
+                self.request, _("The import can not be resumed"), 'warning')
+        self.request.response.redirect(self.context.absolute_url())
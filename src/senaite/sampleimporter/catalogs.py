@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""Map of portal_type to the catalog that indexes it.
+
+archetype_tool.catalog_map is read once per site and kept for the life of
+the process. Only catalog ids are kept, the catalogs are fetched from the
+site of the caller, so no persistent objects are shared between ZODB
+connections. The map is dropped whenever a GenericSetup profile is imported,
+which is how catalog_map is changed.
+"""
+
+import threading
+
+from Products.CMFCore.utils import getToolByName
+from zope.component.hooks import getSite
+
+# Catalog Archetypes uses for types without an entry in catalog_map
+DEFAULT_CATALOG = 'portal_catalog'
+
+_catalog_ids = {}
+_lock = threading.Lock()
+
+
+def get_portal(context):
+    """Returns the site of the context
+    """
+    site = getSite()
+    if site is None:
+        site = getToolByName(context, 'portal_url').getPortalObject()
+    return site
+
+
+def get_catalog_ids(context):
+    """Returns the catalog id of each portal_type of the site
+    """
+    site = get_portal(context)
+    key = '/'.join(site.getPhysicalPath())
+    catalog_ids = _catalog_ids.get(key)
+    if catalog_ids is None:
+        at = getToolByName(site, 'archetype_tool')
+        catalog_ids = dict((portal_type, catalogs[0])
+                           for portal_type, catalogs in at.catalog_map.items()
+                           if catalogs)
+        with _lock:
+            _catalog_ids[key] = catalog_ids
+    return catalog_ids
+
+
+def get_catalog_id(context, portal_type):
+    """Returns the id of the catalog that indexes the portal_type
+    """
+    return get_catalog_ids(context).get(portal_type, DEFAULT_CATALOG)
+
+
+def get_catalog(context, portal_type):
+    """Returns the catalog that indexes the portal_type
+    """
+    return getattr(get_portal(context), get_catalog_id(context, portal_type))
+
+
+def invalidate_catalog_ids():
+    """Drop the catalog ids of all sites
+    """
+    with _lock:
+        _catalog_ids.clear()
+
+
+def profile_imported(event):
+    """Subscriber of IProfileImportedEvent, a profile may change catalog_map
+    """
+    invalidate_catalog_ids()
@@ -18,13 +18,14 @@
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
-import csv
+import random
 import sys
+import time
 import transaction
 
 from AccessControl import ClassSecurityInfo
+from contextlib import closing
 from copy import deepcopy
-from DateTime.DateTime import DateTime
 from bika.lims.browser import ulocalized_time
 from bika.lims.browser.widgets import ReferenceWidget as bReferenceWidget
 from bika.lims.content.bikaschema import BikaSchema
@@ -38,6 +39,8 @@ from Products.Archetypes.atapi import BaseContent
 from Products.Archetypes.atapi import registerType
 from Products.Archetypes.atapi import Schema
 from Products.Archetypes.public import ComputedWidget
+from Products.Archetypes.public import IntegerField
+from Products.Archetypes.public import IntegerWidget
 from Products.Archetypes.public import LinesField
 from Products.Archetypes.public import LinesWidget
 from Products.Archetypes.public import ReferenceField
@@ -54,10 +57,50 @@ from Products.DataGridField import DataGridWidget
 from Products.DataGridField import DateColumn
 from Products.DataGridField import LinesColumn
 from Products.DataGridField import SelectColumn
+from ZODB.interfaces import BlobError
+from ZODB.POSException import ConflictError
+from senaite.sampleimporter.arschema import get_ar_schema
+from senaite.sampleimporter.cache import parsed_files
+from senaite.sampleimporter.catalogs import get_catalog
+from senaite.sampleimporter.catalogs import get_catalog_id
+from senaite.sampleimporter.document import AR_FIELD
+from senaite.sampleimporter.document import CONTAINER_TYPE
+from senaite.sampleimporter.document import ColumnPlan
+from senaite.sampleimporter.document import KEYWORD
+from senaite.sampleimporter.document import NR_ANALYSES
+from senaite.sampleimporter.document import PROFILE
+from senaite.sampleimporter.document import SAMPLE_ID
+from senaite.sampleimporter.document import SAMPLE_MATRIX
+from senaite.sampleimporter.document import is_selected
+from senaite.sampleimporter.document import parse_rows
 from senaite.sampleimporter.interfaces import ISampleImport
+from senaite.sampleimporter.jobs import DONE
+from senaite.sampleimporter.jobs import FAILED
+from senaite.sampleimporter.jobs import ImportProgress
+from senaite.sampleimporter.jobs import QUEUED
+from senaite.sampleimporter.jobs import RUNNING
+from senaite.sampleimporter.jobs import drop_jobs
+from senaite.sampleimporter.jobs import enqueue
+from senaite.sampleimporter.jobs import get_jobs
+from senaite.sampleimporter.jobs import is_claimed
+from senaite.sampleimporter.jobs import start_jobs
+from senaite.sampleimporter.munge import REFERENCE_TYPES
+from senaite.sampleimporter.munge import detect_date_format
+from senaite.sampleimporter.munge import munge_cell
+from senaite.sampleimporter.munge import munge_columns
 from senaite.sampleimporter import logger
 from senaite.sampleimporter import PRODUCT_NAME
 from senaite.sampleimporter import senaiteMessageFactory as _
+from senaite.sampleimporter.reader import checksum
+from senaite.sampleimporter.reader import gzip_file
+from senaite.sampleimporter.reader import is_compressed
+from senaite.sampleimporter.reader import iter_rows
+from senaite.sampleimporter.reader import open_mapped
+from senaite.sampleimporter.resolver import ReferenceResolver
+from senaite.sampleimporter.services import get_service_index
+from senaite.sampleimporter.settings import get_bool_setting
+from senaite.sampleimporter.settings import get_int_setting
+from StringIO import StringIO
 from zope.interface import implements
 
 
@@ -221,6 +264,41 @@ Errors = LinesField(
     )
 )
 
+ImportStatus = StringField(
+    'ImportStatus',
+    widget=StringWidget(
+        label=_('Import status'),
+        visible={'edit': 'invisible', 'view': 'visible'},
+    ),
+)
+
+ImportCheckpoint = IntegerField(
+    'ImportCheckpoint',
+    default=0,
+    widget=IntegerWidget(
+        label=_('Imported rows'),
+        visible={'edit': 'invisible', 'view': 'visible'},
+    ),
+)
+
+ImportConflicts = IntegerField(
+    'ImportConflicts',
+    default=0,
+    widget=IntegerWidget(
+        label=_('Import conflicts'),
+        visible={'edit': 'invisible', 'view': 'visible'},
+    ),
+)
+
+ImportRetries = IntegerField(
+    'ImportRetries',
+    default=0,
+    widget=IntegerWidget(
+        label=_('Import retries'),
+        visible={'edit': 'invisible', 'view': 'visible'},
+    ),
+)
+
 schema = BikaSchema.copy() + Schema((
     OriginalFile,
     Filename,
@@ -234,6 +312,10 @@ schema = BikaSchema.copy() + Schema((
     Batch,
     SampleData,
     Errors,
+    ImportStatus,
+    ImportCheckpoint,
+    ImportConflicts,
+    ImportRetries,
 ))
 
 schema['title'].validators = ()
@@ -298,69 +380,279 @@ class SampleImport(BaseContent):
             workflow.doActionFor(self, 'validate')
 
     def workflow_script_import(self):
-        """Create objects from valid SampleImport
+        """Create objects from valid SampleImport. With import_queue set in
+        zope.conf, a background job is queued instead, with import_threads
+        or import_chunk_size the rows are created by threads once the
+        transition is committed (see jobs.py)
         """
-        bsc = getToolByName(self, 'bika_setup_catalog')
         client = self.aq_parent
+        if get_bool_setting('import_queue') or \
+                get_int_setting('import_threads') > 1 or \
+                get_int_setting('import_chunk_size'):
+            self.queue_import()
+        else:
+            self.import_rows()
+        self.REQUEST.response.redirect(client.absolute_url())
+
+    def queue_import(self):
+        """Queue the jobs that create the rows not imported yet. Without
+        import_queue, they are run by threads of this process once the
+        current transaction is committed, so the import transition is never
+        committed halfway, split into import_threads shards
+        """
+        if get_bool_setting('import_queue'):
+            enqueue(self)
+        else:
+            nr_threads = get_int_setting('import_threads')
+            start_jobs(self, enqueue(self, nr_threads))
 
-        profiles = [x.getObject() for x in bsc(portal_type='AnalysisProfile')]
+    @security.public
+    def can_resume_import(self):
+        """Checks if the import stopped before all rows were created and no
+        worker is running it
+        """
+        workflow = getToolByName(self, 'portal_workflow')
+        if workflow.getInfoFor(self, 'review_state', '') != 'imported':
+            return False
+        if self.getImportStatus() not in (QUEUED, RUNNING, FAILED):
+            return False
+        return not any(is_claimed(job) for job_id, job in get_jobs(self))
 
+    def resume_import(self):
+        """Queue the rows of an import that stopped again, see
+        can_resume_import
+        """
+        drop_jobs(self)
+        self.queue_import()
+
+    def import_rows(self):
+        """Create the AnalysisRequests of all SampleData rows in the current
+        transaction
+        """
         gridrows = self.schema['SampleData'].get(self)
-        row_cnt = 0
+        memo = self.get_import_memo(gridrows)
         for therow in gridrows:
-            row = deepcopy(therow)
-            row_cnt += 1
+            self.import_row(therow, memo)
+        self.setImportCheckpoint(len(gridrows))
+        self.setImportStatus(DONE)
+
+    def run_import(self, progress=None):
+        """Create the AnalysisRequests of the SampleData rows, for the jobs
+        of jobs.py.
+
+        A transaction is committed after each chunk of import_chunk_size
+        rows, or after all rows when it is not set, and the number of rows
+        done is stored as checkpoint. Conflicting chunks are retried, see
+        import_chunk. A new run starts after the checkpoint, so an
+        interrupted import resumes where it stopped.
+
+        progress is the range of rows to create and where its checkpoint is
+        kept, an ImportShard for sharded imports. By default all rows are
+        created and the checkpoint is kept in the fields of this import.
+        """
+        if progress is None:
+            self.setImportStatus(RUNNING)
+            progress = ImportProgress(self)
+        gridrows = self.schema['SampleData'].get(self)
+        memo = self.get_import_memo(
+            gridrows, getattr(progress, 'services', None))
+        start = progress.checkpoint
+        end = progress.end
+        chunk_size = get_int_setting('import_chunk_size') or max(1, end - start)
+        if start > progress.start:
+            logger.info("Resuming import of {} at row {}".format(
+                self.getId(), start + 1))
+        if start >= end:
+            progress.finish()
+        # Commit the start of the import on its own, so that its status is
+        # shown while the first chunk runs
+        self.commit_checkpoint(progress, start)
+        for nr in range(start, end, chunk_size):
+            self.import_chunk(gridrows, nr, min(nr + chunk_size, end), memo,
+                              progress)
+
+    def import_chunk(self, gridrows, start, end, memo, progress):
+        """Create the rows start to end in a transaction of their own.
+
+        On a ConflictError the chunk is rolled back and tried again, up to
+        import_conflict_retries times, after an exponential backoff with
+        jitter. Conflicts and retries are added up in the progress, also
+        when the chunk fails.
+        """
+        max_retries = get_int_setting('import_conflict_retries')
+        backoff = get_int_setting('import_retry_backoff') / 1000.0
+        conflicts = retries = 0
+        while True:
+            try:
+                for nr in range(start, end):
+                    self.import_row(gridrows[nr], memo)
+                if end == progress.end:
+                    progress.finish()
+                progress.conflicts += conflicts
+                progress.retries += retries
+                self.commit_checkpoint(progress, end)
+                return
+            except ConflictError:
+                transaction.abort()
+                conflicts += 1
+                if retries >= max_retries:
+                    logger.error(
+                        "Import of {}: rows {} to {} failed after {} "
+                        "conflicts".format(self.getId(), start + 1, end,
+                                           conflicts))
+                    self.commit_conflicts(progress, conflicts, retries)
+                    raise
+                retries += 1
+                delay = backoff * 2 ** (retries - 1)
+                delay *= random.uniform(0.5, 1.5)
+                logger.warn("Import of {}: conflict in rows {} to {}, retry "
+                            "{} in {:.2f}s".format(self.getId(), start + 1,
+                                                   end, retries, delay))
+                time.sleep(delay)
+
+    def commit_conflicts(self, progress, conflicts, retries):
+        """Add the conflicts and retries of a failed chunk to the progress,
+        in a transaction of its own
+        """
+        progress.conflicts += conflicts
+        progress.retries += retries
+        try:
+            transaction.commit()
+        except ConflictError:
+            transaction.abort()
+            logger.warn("Import of {}: conflicts of the failed chunk not "
+                        "recorded".format(self.getId()))
+
+    def commit_checkpoint(self, progress, checkpoint):
+        """Store the number of rows done and commit the transaction
+        """
+        progress.checkpoint = checkpoint
+        transaction.commit()
+        logger.info("Import of {}: {} rows committed".format(
+            self.getId(), checkpoint))
+
+    def get_import_memo(self, gridrows, services=None):
+        """Return the values shared by the rows of an import: the services
+        of all Analyses values, resolved here unless given, and the memos of
+        the profile expansion
+        """
+        if services is None:
+            services = self.resolve_services(gridrows)
+        return {
+            'services': services,
+            'profile_uids': {},
+            'profile_services': {},
+        }
 
-            # Profiles are titles, profile keys, or UIDS: convert them to UIDs.
+    def import_row(self, therow, memo):
+        """Create the AnalysisRequest of a SampleData row
+        """
+        client = self.aq_parent
+        index = get_service_index(self)
+        row = deepcopy(therow)
+
+        # Profiles are titles, profile keys, or UIDS: convert them to UIDs.
+        # Each distinct selection of profiles is converted once
+        selection = tuple(row['Profiles'])
+        newprofiles = memo['profile_uids'].get(selection)
+        if newprofiles is None:
             newprofiles = []
-            for title in row['Profiles']:
-                objects = [x for x in profiles
-                           if title in (x.getProfileKey(), x.UID(), x.Title())]
-                for obj in objects:
-                    newprofiles.append(obj.UID())
-            row['Profiles'] = newprofiles
-
-            # Same for analyses
-            newanalyses = set(self.get_row_services(row) +
-                              self.get_row_profile_services(row))
-
-            # get batch
-            batch = self.schema['Batch'].get(self)
-            if batch:
-                row['Batch'] = batch.UID()
-
-            # Add AR fields from schema into this row's data
-            if not row.get('ClientReference'):
-                row['ClientReference'] = self.getClientReference()
-            row['ClientOrderNumber'] = self.getClientOrderNumber()
-            contact_uid =\
-                self.getContact().UID() if self.getContact() else None
-            row['Contact'] = contact_uid
-
-            # Creating analysis request from gathered data
-            create_analysisrequest(
-                client,
-                self.REQUEST,
-                row,
-                analyses=list(newanalyses),)
+            for title in selection:
+                uid = index.get_profile_uid(title)
+                if uid:
+                    newprofiles.append(uid)
+            memo['profile_uids'][selection] = newprofiles
+        row['Profiles'] = list(newprofiles)
+
+        # Same for analyses
+        newanalyses = set(self.get_row_services(row, memo['services']))
+        newanalyses.update(
+            self.get_row_profile_services(row, memo['profile_services']))
+
+        # get batch
+        batch = self.schema['Batch'].get(self)
+        if batch:
+            row['Batch'] = batch.UID()
+
+        # Add AR fields from schema into this row's data
+        if not row.get('ClientReference'):
+            row['ClientReference'] = self.getClientReference()
+        row['ClientOrderNumber'] = self.getClientOrderNumber()
+        contact_uid =\
+            self.getContact().UID() if self.getContact() else None
+        row['Contact'] = contact_uid
+
+        # Creating analysis request from gathered data
+        return create_analysisrequest(
+            client,
+            self.REQUEST,
+            row,
+            analyses=list(newanalyses),)
+
+    def setOriginalFile(self, value, **kwargs):
+        """Set the original file and drop the cached parsed document. If
+        compress_uploads is enabled in zope.conf, uncompressed files are
+        stored gzip compressed
+        """
+        if value and get_bool_setting('compress_uploads'):
+            fileobj = value
+            if isinstance(value, basestring):
+                fileobj = StringIO(value)
+            if hasattr(fileobj, 'seek') and not is_compressed(fileobj):
+                with closing(gzip_file(fileobj)) as compressed:
+                    value = compressed.read()
+        self.getField('OriginalFile').set(self, value, **kwargs)
+        self._v_parsed_document = None
+
+    def get_original_file_version(self):
+        """Returns a key that changes whenever the OriginalFile blob changes
+        """
+        blob = getattr(self.getOriginalFile(), 'getBlob', None)
+        blob = blob() if blob else None
+        if blob is None:
+            return None
+        return blob._p_oid, blob._p_serial, id(blob)
 
-        self.REQUEST.response.redirect(client.absolute_url())
+    def open_original_file(self):
+        """Returns a read-only file handle on the OriginalFile blob, to be used
+        in a with statement. Committed blobs are memory-mapped from the blob
+        storage, uncommitted ones are read through the blob's own file
+        """
+        blob = self.getOriginalFile().getBlob()
+        blob._p_activate()
+        try:
+            filename = blob.committed()
+        except BlobError:
+            return blob.open('r')
+        return open_mapped(filename)
+
+    def get_parsed_document(self):
+        """Returns the sections of the original input file, parsed in a single
+        pass. The result is cached on the object for the current blob version,
+        and in the process-wide parsed files cache for the file's checksum.
+        The document is shared, so it must not be modified
+        """
+        version = self.get_original_file_version()
+        cached = getattr(self, '_v_parsed_document', None)
+        if cached and cached[0] == version:
+            return cached[1]
+        # Files with the same contents are parsed once per process
+        with self.open_original_file() as fileobj:
+            key = checksum(fileobj)
+        document = parsed_files.get(key)
+        if document is None:
+            with self.open_original_file() as fileobj:
+                document = parse_rows(iter_rows(fileobj))
+            parsed_files.set(key, document, document.get_size())
+        self._v_parsed_document = (version, document)
+        return document
 
     def get_header_values(self):
         """Scrape the "Header" values from the original input file
         """
-        lines = self.getOriginalFile().data.splitlines()
-        reader = csv.reader(lines)
-        header_fields = header_data = []
-        for row in reader:
-            if not any(row):
-                continue
-            if row[0].strip().lower() == 'header':
-                header_fields = [x.strip() for x in row][1:]
-                continue
-            if row[0].strip().lower() == 'header data':
-                header_data = [x.strip() for x in row][1:]
-                break
+        document = self.get_parsed_document()
+        header_fields = document.header_fields
+        header_data = document.header_data
         if not (header_data or header_fields):
             return None
         if not (header_data and header_fields):
@@ -376,8 +668,6 @@ class SampleImport(BaseContent):
     def save_header_data(self):
         """Save values from the file's header row into their schema fields.
         """
-        client = self.aq_parent
-
         headers = self.get_header_values()
         if not headers:
             return False
@@ -399,14 +689,14 @@ class SampleImport(BaseContent):
 
         # Primary Contact
         v = headers.get('Contact', None)
-        contacts = [x for x in client.objectValues('Contact')]
-        contact = [c for c in contacts if c.Title() == v]
+        contacts = self.get_client_contacts()
+        contact = [uid for name, uid in contacts if name == v]
         if contact:
             self.schema['Contact'].set(self, contact)
         else:
             self.error("Specified contact '%s' does not exist; using '%s'" %
-                       (v, contacts[0].Title()))
-            self.schema['Contact'].set(self, contacts[0])
+                       (v, contacts[0][0]))
+            self.schema['Contact'].set(self, contacts[0][1])
         del (headers['Contact'])
 
         # CCContacts
@@ -433,6 +723,20 @@ class SampleImport(BaseContent):
             unexpected = ','.join(headers.keys())
             self.error("Unexpected header fields: %s" % unexpected)
 
+        # Keep the uniqueness indexes of validate_headers up to date
+        self.reindexObject(idxs=['getClientOrderNumber', 'getClientReference'])
+
+    def get_client_contacts(self):
+        """Return a list of (fullname, UID) tuples of the contacts of the
+        client, read from the catalog without waking the contacts
+        """
+        client = self.aq_parent
+        catalog = get_catalog(self, 'Contact')
+        path = '/'.join(client.getPhysicalPath())
+        brains = catalog(portal_type='Contact',
+                         path={'query': path, 'depth': 1})
+        return [(brain.Title, brain.UID) for brain in brains]
+
     def get_sample_values(self):
         """Read the rows specifying Samples and return a dictionary with
         related data.
@@ -446,54 +750,41 @@ class SampleImport(BaseContent):
             samples - All other sample rows.
 
         """
+        document = self.get_parsed_document()
         res = {'samples': []}
-        lines = self.getOriginalFile().data.splitlines()
-        reader = csv.reader(lines)
-        next_rows_are_sample_rows = False
-        for row in reader:
-            if not any(row):
-                continue
-            if next_rows_are_sample_rows:
-                vals = [x.strip() for x in row]
-                if not any(vals):
-                    continue
-                res['samples'].append(zip(res['headers'], vals))
-            elif row[0].strip().lower() == 'samples':
-                res['headers'] = [x.strip() for x in row]
-            elif row[0].strip().lower() == 'total analyses or profiles':
-                res['total_analyses'] = \
-                    zip(res['headers'], [x.strip() for x in row])
-                next_rows_are_sample_rows = True
+        if document.sample_headers is not None:
+            res['headers'] = list(document.sample_headers)
+        if document.total_analyses is not None:
+            res['total_analyses'] = zip(res['headers'],
+                                        document.total_analyses)
+            res['samples'] = [row.items()
+                              for row in self.iter_sample_values()]
         return res
 
-    def get_ar(self):
-        """Create a temporary AR to fetch the fields from
+    def iter_sample_values(self):
+        """Yield the sample rows of the original input file one at a time.
+        Each row is a read-only mapping of sample header to value, backed by
+        the columns of the parsed document
         """
-        logger.info("*** CREATING TEMPORARY AR ***")
-        return self.restrictedTraverse(
-            "portal_factory/AnalysisRequest/Request new analyses")
+        samples = self.get_parsed_document().samples
+        if samples is None:
+            return iter([])
+        return iter(samples)
 
     def get_ar_schema(self):
-        """Return the AR schema
+        """Return the cached descriptor of the AR schema fields, see
+        arschema.get_ar_schema
         """
-        logger.info("*** GET AR SCHEMA ***")
-        ar = self.get_ar()
-        return ar.Schema()
+        return get_ar_schema(self)
 
     def save_sample_data(self):
         """Save values from the file's header row into the DataGrid columns
         after doing some very basic validation
         """
-        bsc = getToolByName(self, 'bika_setup_catalog')
-        keywords = self.bika_setup_catalog.uniqueValuesFor('getKeyword')
-        profiles = []
-        for p in bsc(portal_type='AnalysisProfile'):
-            p = p.getObject()
-            profiles.append(p.Title())
-            profiles.append(p.getProfileKey())
+        index = get_service_index(self)
 
-        sample_data = self.get_sample_values()
-        if not sample_data:
+        document = self.get_parsed_document()
+        if document.total_analyses is None:
             self.error("No sample data found")
             return False
 
@@ -502,9 +793,9 @@ class SampleImport(BaseContent):
             return False
 
         # Incorrect number of samples
-        if len(sample_data.get('samples', [])) != int(self.getNrSamples()):
+        if document.nr_samples != int(self.getNrSamples()):
             self.error("No of Samples: {} expected but only {} found".format(
-                self.getNrSamples(), len(sample_data.get('samples', []))))
+                self.getNrSamples(), document.nr_samples))
             return False
 
         # columns that we expect, but do not find, are listed here.
@@ -522,75 +813,75 @@ class SampleImport(BaseContent):
         # This will be the new sample-data field value, when we are done.
         grid_rows = []
 
+        # Classify the sample columns once, rows are then processed
+        # column by column without matching their headers
         ar_schema = self.get_ar_schema()
-        row_nr = 0
-        for row in sample_data['samples']:
-            row = dict(row)
-            row_nr += 1
+        plan = ColumnPlan(document.samples, ar_schema, index.keywords,
+                          index.profile_tokens)
+        sids = plan.get_cells(SAMPLE_ID)
+        nr_analyses = plan.get_cells(NR_ANALYSES)
+        container_types = plan.get_cells(CONTAINER_TYPE)
+        sample_matrices = plan.get_cells(SAMPLE_MATRIX)
+        ar_fields = plan[AR_FIELD]
+        keyword_columns = plan[KEYWORD]
+        profile_columns = plan[PROFILE]
+
+        # Convert the AR field columns that do not need the catalog at once
+        munged = self.munge_sample_columns(ar_schema, ar_fields)
+        # References are resolved from Title/UID maps loaded per portal_type,
+        # the distinct values of each column before the rows are processed
+        resolver = ReferenceResolver(self)
+        resolver.prefetch(('ContainerType',), container_types or [])
+        resolver.prefetch(('SampleMatrix',), sample_matrices or [])
+        for k, cells in ar_fields:
+            if ar_schema[k].type in REFERENCE_TYPES:
+                resolver.prefetch(ar_schema[k].allowed_types, cells)
+
+        for nr in range(document.nr_samples):
+            row_nr = nr + 1
 
             # sid is just for referring the user back to row X in their
             # in put spreadsheet
-            gridrow = {'sid': row['Samples']}
-            del (row['Samples'])
+            gridrow = {'sid': sids[nr]}
 
             # We'll use this later to verify the number against selections
-            if 'Total number of Analyses or Profiles' in row:
-                nr_an = row['Total number of Analyses or Profiles']
-                del (row['Total number of Analyses or Profiles'])
-            else:
-                nr_an = 0
             try:
-                nr_an = int(nr_an)
-            except ValueError:
+                nr_an = int(nr_analyses[nr] if nr_analyses else 0)
+            except (TypeError, ValueError):
                 nr_an = 0
 
             # ContainerType - not part of sample or AR schema
-            if 'ContainerType' in row:
-                title = row['ContainerType']
-                if title:
-                    obj = self.lookup(('ContainerType',),
-                                      Title=row['ContainerType'])
-                    if obj:
-                        gridrow['ContainerType'] = obj[0].UID
-                del (row['ContainerType'])
+            title = container_types[nr] if container_types else None
+            if title:
+                uids = resolver.resolve(('ContainerType',), title)
+                if uids:
+                    gridrow['ContainerType'] = uids[0]
 
             # SampleMatrix - not part of sample or AR schema
-            if 'SampleMatrix' in row:
-                title = row['SampleMatrix']
-                if title:
-                    obj = self.lookup(('SampleMatrix',),
-                                      Title=row['SampleMatrix'])
-                    if obj:
-                        gridrow['SampleMatrix'] = obj[0].UID
-                del (row['SampleMatrix'])
+            title = sample_matrices[nr] if sample_matrices else None
+            if title:
+                uids = resolver.resolve(('SampleMatrix',), title)
+                if uids:
+                    gridrow['SampleMatrix'] = uids[0]
 
             # match against ar schema
-            for k, v in row.items():
-                if k in ['Analyses', 'Profiles']:
-                    continue
-                if k in ar_schema:
-                    del (row[k])
-                    if v:
-                        try:
-                            value = self.munge_field_value(
-                                ar_schema, row_nr, k, v)
-                            gridrow[k] = value
-                        except ValueError as e:
-                            errors.append(e.message)
-
-            # Count and remove Keywords and Profiles from the list
-            gridrow['Analyses'] = []
-            for k, v in row.items():
-                if k in keywords:
-                    del (row[k])
-                    if str(v).strip().lower() not in ('', '0', 'false'):
-                        gridrow['Analyses'].append(k)
-            gridrow['Profiles'] = []
-            for k, v in row.items():
-                if k in profiles:
-                    del (row[k])
-                    if str(v).strip().lower() not in ('', '0', 'false'):
-                        gridrow['Profiles'].append(k)
+            for k, cells in ar_fields:
+                v = cells[nr]
+                if v:
+                    try:
+                        value = self.munge_field_value(
+                            ar_schema, row_nr, k, v,
+                            munged=munged[k][nr] if k in munged else None,
+                            resolver=resolver)
+                        gridrow[k] = value
+                    except ValueError as e:
+                        errors.append(e.message)
+
+            # Keywords and Profiles selected in this row
+            gridrow['Analyses'] = [k for k, cells in keyword_columns
+                                   if is_selected(cells[nr])]
+            gridrow['Profiles'] = [k for k, cells in profile_columns
+                                   if is_selected(cells[nr])]
             if len(gridrow['Analyses']) + len(gridrow['Profiles']) != nr_an:
                 errors.append(
                     "Row %s: Number of analyses does not match provided value" %
@@ -598,6 +889,8 @@ class SampleImport(BaseContent):
 
             grid_rows.append(gridrow)
 
+        logger.info("Resolved sample references with {} catalog queries"
+                    .format(resolver.queries))
         self.setSampleData(grid_rows)
 
         if missing:
@@ -614,18 +907,9 @@ class SampleImport(BaseContent):
     def get_batch_header_values(self):
         """Scrape the "Batch Header" values from the original input file
         """
-        lines = self.getOriginalFile().data.splitlines()
-        reader = csv.reader(lines)
-        batch_headers = batch_data = []
-        for row in reader:
-            if not any(row):
-                continue
-            if row[0].strip().lower() == 'batch header':
-                batch_headers = [x.strip() for x in row][1:]
-                continue
-            if row[0].strip().lower() == 'batch data':
-                batch_data = [x.strip() for x in row][1:]
-                break
+        document = self.get_parsed_document()
+        batch_headers = document.batch_headers
+        batch_data = document.batch_data
         if not (batch_data or batch_headers):
             return None
         if not (batch_data and batch_headers):
@@ -648,11 +932,10 @@ class SampleImport(BaseContent):
         # use the existing object.
         batch_title = batch_headers.get('title', False)
         if batch_title:
-            existing_batch = [x for x in client.objectValues('Batch')
-                              if x.title == batch_title]
+            existing_batch = self.find_batch(batch_title)
             if existing_batch:
-                self.setBatch(existing_batch[0])
-                return existing_batch[0]
+                self.setBatch(existing_batch)
+                return existing_batch
         # If the batch title is specified but does not exist,
         # we will attempt to create the bach now.
         if 'title' in batch_headers:
@@ -665,7 +948,28 @@ class SampleImport(BaseContent):
             batch.edit(**batch_headers)
             self.setBatch(batch)
 
-    def munge_field_value(self, schema, row_nr, fieldname, value):
+    def find_batch(self, title):
+        """Return the batch of the client with the given title, or None.
+        The Title index narrows the batches down, the exact title is then
+        compared on the catalog metadata
+        """
+        client = self.aq_parent
+        catalog = get_catalog(self, 'Batch')
+        query = dict(portal_type='Batch',
+                     path={'query': '/'.join(client.getPhysicalPath()),
+                           'depth': 1})
+        try:
+            brains = catalog(Title=title, **query)
+        except Exception:
+            # titles the text index cannot parse, e.g. with parentheses
+            brains = catalog(**query)
+        for brain in brains:
+            if brain.Title == title:
+                return brain.getObject()
+        return None
+
+    def munge_field_value(self, schema, row_nr, fieldname, value,
+                          munged=None, resolver=None):
         """Convert a spreadsheet value into a field value that fits in
         the corresponding schema field.
         - boolean: All values are true except '', 'false', or '0'.
@@ -677,36 +981,83 @@ class SampleImport(BaseContent):
         it will flag 'validation' errors, as this is the only chance we will
         get to complain about these field values.
 
+        munged is the converted (value, valid) tuple of the cell, if the
+        column was converted already (see munge_sample_columns). resolver is
+        the ReferenceResolver of the import.
         """
         field = schema[fieldname]
-        if field.type == 'boolean':
-            value = str(value).strip().lower()
-            value = '' if value in ['0', 'no', 'false', 'none'] else '1'
-            return value
-        if field.type in ['reference', 'uidreference']:
+        if field.type in REFERENCE_TYPES:
             value = str(value).strip()
             if len(value) < 2:
                 raise ValueError('Row %s: value is too short (%s=%s)' % (
                     row_nr, fieldname, value))
-            brains = self.lookup(field.allowed_types, Title=value)
-            if not brains:
-                brains = self.lookup(field.allowed_types, UID=value)
-            if not brains:
+            if resolver is None:
+                resolver = ReferenceResolver(self)
+            uids = resolver.resolve(field.allowed_types, value)
+            if not uids:
                 raise ValueError('Row %s: value is invalid (%s=%s)' % (
                     row_nr, fieldname, value))
             if field.multiValued:
-                return [b.UID for b in brains] if brains else []
+                return uids
             else:
-                return brains[0].UID if brains else None
-        if field.type == 'datetime':
-            try:
-                value = DateTime(value)
-                return ulocalized_time(
-                    value, long_format=True, time_only=False, context=self)
-            except Exception as e:
-                raise ValueError('Row %s: value is invalid (%s=%s)' % (
-                    row_nr, fieldname, value))
-        return str(value)
+                return uids[0]
+        if munged is None:
+            munged = munge_cell(field.type, value)
+            if field.type == 'datetime':
+                munged = self.localize_date(munged)
+        munged_value, valid = munged
+        if not valid:
+            raise ValueError('Row %s: value is invalid (%s=%s)' % (
+                row_nr, fieldname, value))
+        return munged_value
+
+    def localize_date(self, munged):
+        """Localize a munged datetime cell, returns a (value, valid) tuple
+        """
+        date, valid = munged
+        if not valid:
+            return munged
+        try:
+            return ulocalized_time(date, long_format=True,
+                                   time_only=False, context=self), True
+        except Exception:
+            return None, False
+
+    def munge_sample_columns(self, schema, columns):
+        """Convert the cells of the AR field columns that do not hold
+        references, see munge.munge_columns. Returns a dict that maps the
+        field name to the converted cells of its column.
+
+        With munge_processes set in zope.conf the columns are converted in a
+        pool of worker processes, otherwise in this thread. Datetime cells
+        are returned localized.
+        """
+        columns = [(k, cells) for k, cells in columns
+                   if schema[k].type not in REFERENCE_TYPES]
+        if not columns:
+            return {}
+        processes = get_int_setting('munge_processes')
+        chunk_size = get_int_setting('munge_chunk_size')
+        start = time.time()
+        munged = munge_columns(
+            [(schema[k].type, cells) for k, cells in columns],
+            processes=processes, chunk_size=chunk_size)
+        # Dates are localized here, each distinct date once
+        for (k, cells), column in zip(columns, munged):
+            if schema[k].type != 'datetime':
+                continue
+            localized = {}
+            for nr, cell in enumerate(cells):
+                if cell:
+                    if cell not in localized:
+                        localized[cell] = self.localize_date(column[nr])
+                    column[nr] = localized[cell]
+        logger.info("Converted {} sample columns of {} rows in {:.3f}s ({})"
+                    .format(len(columns), len(columns[0][1]),
+                            time.time() - start,
+                            processes and "{} processes".format(processes)
+                            or "serial"))
+        return dict(zip([k for k, cells in columns], munged))
 
     def validate_headers(self):
         """Validate headers fields from schema
@@ -727,35 +1078,28 @@ class SampleImport(BaseContent):
             self.error("%s: value is invalid (%s)." % (
                 'Client ID', self.getClientID()))
 
-        existing_sampleimports = pc(portal_type='SampleImport', review_state=['valid', 'imported'])
-        # Verify Client Order Number
-        for sampleimport in existing_sampleimports:
-            if sampleimport.UID == self.UID() \
-                    or not sampleimport.getClientOrderNumber():
-                continue
-            sampleimport = sampleimport.getObject()
-
-            if sampleimport.getClientOrderNumber() == self.getClientOrderNumber():
-                self.error('%s: already used by existing SampleImport.' %
-                           'ClientOrderNumber')
-                break
-
-        # Verify Client Reference
-        for sampleimport in existing_sampleimports:
-            if sampleimport.UID == self.UID() \
-                    or not sampleimport.getClientReference():
+        # Verify Client Order Number and Client Reference are unique, both
+        # are indexed in the portal_catalog
+        for index, name, value in [
+            ('getClientOrderNumber', 'ClientOrderNumber',
+             self.getClientOrderNumber()),
+            ('getClientReference', 'ClientReference',
+             self.getClientReference()),
+        ]:
+            if not value:
                 continue
-            sampleimport = sampleimport.getObject()
-            if sampleimport.getClientReference() == self.getClientReference():
+            query = {'portal_type': 'SampleImport',
+                     'review_state': ['valid', 'imported'],
+                     index: value}
+            if [b for b in pc(**query) if b.UID != self.UID()]:
                 self.error('%s: already used by existing SampleImport.' %
-                           'ClientReference')
-                break
+                           name)
 
         # getCCContacts has no value if object is not complete (eg during test)
         if self.getCCContacts():
             cc_contacts = self.getCCContacts()[0]
-            contacts = [x for x in client.objectValues('Contact')]
-            contact_names = [c.Title() for c in contacts]
+            contact_names = set(
+                name for name, uid in self.get_client_contacts())
             # validate Contact existence in this Client
             for k in ['CCNamesReport', 'CCNamesInvoice']:
                 for val in cc_contacts[k]:
@@ -778,17 +1122,22 @@ class SampleImport(BaseContent):
         that each one is correct
         """
 
-        bsc = getToolByName(self, 'bika_setup_catalog')
-        keywords = bsc.uniqueValuesFor('getKeyword')
-        profiles = []
-        for p in bsc(portal_type='AnalysisProfile'):
-            p = p.getObject()
-            profiles.append(p.Title())
-            profiles.append(p.getProfileKey())
+        index = get_service_index(self)
 
         row_nr = 0
         ar_schema = self.get_ar_schema()
-        for gridrow in self.getSampleData():
+        dates = {}
+        sample_data = self.getSampleData()
+
+        # Check the distinct UIDs of each reference field at once
+        resolver = ReferenceResolver(self)
+        for k in set(k for gridrow in sample_data for k in gridrow):
+            if k in ar_schema and ar_schema[k].type == 'reference':
+                resolver.prefetch_uids(
+                    ar_schema[k].allowed_types,
+                    [gridrow.get(k) for gridrow in sample_data])
+
+        for gridrow in sample_data:
             row_nr += 1
 
             # validate against sample and ar schemas
@@ -798,19 +1147,20 @@ class SampleImport(BaseContent):
                 if k in ar_schema:
                     try:
                         self.validate_against_schema(
-                            ar_schema, row_nr, k, v)
+                            ar_schema, row_nr, k, v, dates=dates,
+                            resolver=resolver)
                     except ValueError as e:
                         self.error(e.message)
 
             an_cnt = 0
             for v in gridrow['Analyses']:
-                if v and v not in keywords:
+                if v and not index.is_keyword(v):
                     self.error("Row %s: value is invalid (%s=%s)" %
                                ('Analysis keyword', row_nr, v))
                 else:
                     an_cnt += 1
             for v in gridrow['Profiles']:
-                if v and v not in profiles:
+                if v and not index.is_profile(v):
                     self.error("Row %s: value is invalid (%s=%s)" %
                                ('Profile Title', row_nr, v))
                 else:
@@ -818,8 +1168,13 @@ class SampleImport(BaseContent):
             if not an_cnt:
                 self.error("Row %s: No valid analyses or profiles" % row_nr)
 
-    def validate_against_schema(self, schema, row_nr, fieldname, value):
-        """
+    def validate_against_schema(self, schema, row_nr, fieldname, value,
+                                dates=None, resolver=None):
+        """Validate a SampleData value against its AR schema field.
+
+        dates is a dict that remembers which date values were valid, so
+        repeated dates of an import are parsed once. resolver is the
+        ReferenceResolver of the import.
         """
         field = schema[fieldname]
         if field.type == 'boolean':
@@ -832,19 +1187,24 @@ class SampleImport(BaseContent):
                     row_nr, fieldname))
             if not value:
                 return value
-            brains = self.lookup(field.allowed_types, UID=value)
-            if not brains:
+            if resolver is None:
+                resolver = ReferenceResolver(self)
+            uids = resolver.by_uid(field.allowed_types, value)
+            if not uids:
                 raise ValueError("Row %s: value is invalid (%s=%s)" % (
                     row_nr, fieldname, value))
             if field.multiValued:
-                return [b.UID for b in brains] if brains else []
+                return uids
             else:
-                return brains[0].UID if brains else None
+                return uids[0]
         if field.type == 'datetime':
-            try:
-                ulocalized_time(DateTime(value), long_format=True,
-                                time_only=False, context=self)
-            except Exception as e:
+            if dates is None:
+                dates = {}
+            if value not in dates:
+                munged = munge_cell(field.type, value,
+                                    detect_date_format([value]))
+                dates[value] = self.localize_date(munged)[1]
+            if not dates[value]:
                 raise ValueError('Row %s: value is invalid (%s=%s)' % (
                     row_nr, fieldname, value))
         return value
@@ -853,12 +1213,10 @@ class SampleImport(BaseContent):
         """Lookup an object of type (allowed_types).  kwargs is sent
         directly to the catalog.
         """
-        at = getToolByName(self, 'archetype_tool')
         if type(allowed_types) not in (list, tuple):
             allowed_types = [allowed_types]
         for portal_type in allowed_types:
-            catalog = at.catalog_map.get(portal_type, [None])[0]
-            catalog = getToolByName(self, catalog)
+            catalog = get_catalog(self, portal_type)
             kwargs['portal_type'] = portal_type
             try:
                 brains = catalog(**kwargs)
@@ -869,44 +1227,57 @@ class SampleImport(BaseContent):
             if brains:
                 return brains
 
-    def get_row_services(self, row):
-        """Return a list of services which are referenced in Analyses.
-        values may be UID, Title or Keyword.
-        """
-        bsc = getToolByName(self, 'bika_setup_catalog')
-        services = set()
-        for val in row.get('Analyses', []):
-            brains = bsc(portal_type='AnalysisService', getKeyword=val)
-            if not brains:
-                brains = bsc(portal_type='AnalysisService', title=val)
-            if not brains:
-                brains = bsc(portal_type='AnalysisService', UID=val)
-            if brains:
-                services.add(brains[0].UID)
+    def resolve_services(self, rows):
+        """Return a dict of the distinct Analyses values of the rows to
+        service UIDs. values may be UID, Title or Keyword. Values that do not
+        match a service are reported once.
+        """
+        index = get_service_index(self)
+        tokens = set(val for row in rows for val in row.get('Analyses', []))
+        services = {}
+        for val in sorted(tokens):
+            uid = index.get_service_uid(val)
+            if uid:
+                services[val] = uid
             else:
                 self.error("Invalid analysis specified: %s" % val)
-        return list(services)
+        return services
 
-    def get_row_profile_services(self, row):
+    def get_row_services(self, row, services=None):
+        """Return a list of services which are referenced in Analyses.
+        services is the result of resolve_services for all rows of the
+        import, the row is resolved on its own if not given.
+        """
+        if services is None:
+            services = self.resolve_services([row])
+        return list(set(services[val] for val in row.get('Analyses', [])
+                        if val in services))
+
+    def get_row_profile_services(self, row, memo=None):
         """Return a list of services which are referenced in profiles
         values may be UID, Title or ProfileKey.
+        memo is a dict shared by the rows of an import: rows that select the
+        same profiles share one frozen set of services.
         """
-        bsc = getToolByName(self, 'bika_setup_catalog')
-        services = set()
-        profiles = [x.getObject() for x in bsc(portal_type='AnalysisProfile')]
-        for val in row.get('Profiles', []):
-            objects = [x for x in profiles
-                       if val in (x.getProfileKey(), x.UID(), x.Title())]
-            if objects:
-                for service in objects[0].getService():
-                    services.add(service.UID())
-            else:
-                self.error("Invalid profile specified: %s" % val)
+        if memo is None:
+            memo = {}
+        selection = tuple(sorted(set(row.get('Profiles', []))))
+        services = memo.get(selection)
+        if services is None:
+            index = get_service_index(self)
+            services = set()
+            for val in selection:
+                uids = index.get_services_of_profile(val)
+                if uids is not None:
+                    services.update(uids)
+                else:
+                    self.error("Invalid profile specified: %s" % val)
+            services = memo[selection] = frozenset(services)
         return list(services)
 
     def Vocabulary_SamplePoint(self):
         vocabulary = CatalogVocabulary(self)
-        vocabulary.catalog = 'bika_setup_catalog'
+        vocabulary.catalog = get_catalog_id(self, 'SamplePoint')
         folders = [self.bika_setup.bika_samplepoints]
         if IClient.providedBy(self.aq_parent):
             folders.append(self.aq_parent)
@@ -914,12 +1285,12 @@ class SampleImport(BaseContent):
 
     def Vocabulary_SampleMatrix(self):
         vocabulary = CatalogVocabulary(self)
-        vocabulary.catalog = 'bika_setup_catalog'
+        vocabulary.catalog = get_catalog_id(self, 'SampleMatrix')
         return vocabulary(allow_blank=True, portal_type='SampleMatrix')
 
     def Vocabulary_SampleType(self):
         vocabulary = CatalogVocabulary(self)
-        vocabulary.catalog = 'bika_setup_catalog'
+        vocabulary.catalog = get_catalog_id(self, 'SampleType')
         folders = [self.bika_setup.bika_sampletypes]
         if IClient.providedBy(self.aq_parent):
             folders.append(self.aq_parent)
@@ -927,7 +1298,7 @@ class SampleImport(BaseContent):
 
     def Vocabulary_ContainerType(self):
         vocabulary = CatalogVocabulary(self)
-        vocabulary.catalog = 'bika_setup_catalog'
+        vocabulary.catalog = get_catalog_id(self, 'ContainerType')
         return vocabulary(allow_blank=True, portal_type='ContainerType')
 
     def error(self, msg):
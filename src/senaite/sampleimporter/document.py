@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import sys
+
+
+class SampleColumns(object):
+    """Columnar store of the sample rows of an import file.
+
+    Each column is a list with one cell per row. Cells that are missing
+    because a row is shorter than the headers are stored as None. Equal
+    strings are stored once, so repeated values like sample type titles or
+    0/1 flags in wide files cost one reference per cell.
+    """
+
+    def __init__(self, headers):
+        self.headers = headers
+        # Later duplicate headers win, like in dict(zip(headers, values))
+        self.index = dict((h, i) for i, h in enumerate(headers))
+        self.fields = sorted(self.index.items(), key=lambda item: item[1])
+        self.columns = [[] for h in headers]
+        self.nr_rows = 0
+        self.size = 0
+        self._pool = {}
+
+    def __len__(self):
+        return self.nr_rows
+
+    def __iter__(self):
+        for nr in range(len(self)):
+            yield SampleRow(self, nr)
+
+    def __getitem__(self, nr):
+        if not 0 <= nr < len(self):
+            raise IndexError(nr)
+        return SampleRow(self, nr)
+
+    def append(self, values):
+        """Add a row of values
+        """
+        pool = self._pool
+        nr_values = len(values)
+        for i, column in enumerate(self.columns):
+            if i < nr_values:
+                value = values[i]
+                column.append(pool.setdefault(value, value))
+            else:
+                column.append(None)
+        self.nr_rows += 1
+
+    def finish(self):
+        """Drop the string pool once all rows are added and compute the
+        approximate memory footprint of the store
+        """
+        size = sys.getsizeof(self.columns)
+        size += sum(map(sys.getsizeof, self.columns))
+        size += sum(map(sys.getsizeof, self._pool))
+        self.size = size
+        self._pool = {}
+
+    def get_column(self, header):
+        """Returns the cells of the column with the given header
+        """
+        return self.columns[self.index[header]]
+
+
+class SampleRow(object):
+    """Read-only mapping of headers to the values of one row of a
+    SampleColumns store. Values are read from the columns, not copied
+    """
+    __slots__ = ('store', 'nr')
+
+    def __init__(self, store, nr):
+        self.store = store
+        self.nr = nr
+
+    def __getitem__(self, key):
+        value = self.store.columns[self.store.index[key]][self.nr]
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        index = self.store.index.get(key)
+        if index is None:
+            return False
+        return self.store.columns[index][self.nr] is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        columns = self.store.columns
+        nr = self.nr
+        items = []
+        for header, index in self.store.fields:
+            value = columns[index][nr]
+            if value is not None:
+                items.append((header, value))
+        return items
+
+    def keys(self):
+        return [item[0] for item in self.items()]
+
+    def values(self):
+        return [item[1] for item in self.items()]
+
+
+# Kinds of sample columns, see ColumnPlan
+SAMPLE_ID = 'sid'
+NR_ANALYSES = 'nr_analyses'
+CONTAINER_TYPE = 'ContainerType'
+SAMPLE_MATRIX = 'SampleMatrix'
+AR_FIELD = 'ar_field'
+KEYWORD = 'keyword'
+PROFILE = 'profile'
+IGNORED = 'ignored'
+UNEXPECTED = 'unexpected'
+
+# Sample columns with a fixed meaning
+SAMPLE_COLUMNS = {
+    'Samples': SAMPLE_ID,
+    'Total number of Analyses or Profiles': NR_ANALYSES,
+    'ContainerType': CONTAINER_TYPE,
+    'SampleMatrix': SAMPLE_MATRIX,
+    'Analyses': IGNORED,
+    'Profiles': IGNORED,
+}
+
+
+class ColumnPlan(object):
+    """The columns of a SampleColumns store, classified once by their header.
+
+    Columns are matched in this order: the fixed sample columns, AR schema
+    fields, analysis service keywords and analysis profiles. Anything else is
+    unexpected. The classified columns are kept as (header, cells) pairs in
+    the list of their kind, so rows are processed without looking up headers.
+    """
+
+    def __init__(self, samples, ar_fields, keywords, profiles):
+        self.columns = {}
+        for kind in (SAMPLE_ID, NR_ANALYSES, CONTAINER_TYPE, SAMPLE_MATRIX,
+                     AR_FIELD, KEYWORD, PROFILE, IGNORED, UNEXPECTED):
+            self.columns[kind] = []
+        for header, index in samples.fields:
+            kind = self.classify(header, ar_fields, keywords, profiles)
+            self.columns[kind].append((header, samples.columns[index]))
+
+    @staticmethod
+    def classify(header, ar_fields, keywords, profiles):
+        """Returns the kind of column for a sample header
+        """
+        if header in SAMPLE_COLUMNS:
+            return SAMPLE_COLUMNS[header]
+        if header in ar_fields:
+            return AR_FIELD
+        if header in keywords:
+            return KEYWORD
+        if header in profiles:
+            return PROFILE
+        return UNEXPECTED
+
+    def __getitem__(self, kind):
+        return self.columns[kind]
+
+    def get_cells(self, kind):
+        """Returns the cells of the single column of the given kind, or None
+        """
+        columns = self.columns[kind]
+        return columns[0][1] if columns else None
+
+    def get_headers(self, kind):
+        """Returns the headers of the columns of the given kind
+        """
+        return [header for header, cells in self.columns[kind]]
+
+
+def is_selected(value):
+    """Checks if the cell of an analysis or profile column selects it
+    """
+    return value is not None and value.lower() not in ('', '0', 'false')
+
+
+class SampleImportDocument(object):
+    """The sections of a sample import file.
+
+    header_fields, header_data - rows with "Header" and "Header Data" in
+        column 0, without the label cell.
+    batch_headers, batch_data - rows with "Batch Header" and "Batch Data" in
+        column 0, without the label cell.
+    sample_headers - row with "Samples" in column 0 (None if not found).
+    total_analyses - row with "Total analyses or profiles" in column 0.
+    samples - SampleColumns store of all rows after the total analyses row
+        (None if there is no total analyses row).
+    """
+
+    def __init__(self):
+        self.header_fields = []
+        self.header_data = []
+        self.batch_headers = []
+        self.batch_data = []
+        self.sample_headers = None
+        self.total_analyses = None
+        self.samples = None
+
+    @property
+    def nr_samples(self):
+        return len(self.samples) if self.samples is not None else 0
+
+    def get_size(self):
+        """Returns the approximate memory footprint of this document in bytes
+        """
+        size = sys.getsizeof(self)
+        for values in (self.header_fields, self.header_data,
+                       self.batch_headers, self.batch_data,
+                       self.sample_headers, self.total_analyses):
+            if values:
+                size += sys.getsizeof(values)
+                size += sum(map(sys.getsizeof, values))
+        if self.samples is not None:
+            size += self.samples.size
+        return size
+
+
+def parse_rows(rows):
+    """Split the rows of an import file into its sections in a single scan
+    and return a SampleImportDocument
+    """
+    doc = SampleImportDocument()
+    header_done = batch_done = in_samples = False
+    for row in rows:
+        if not any(row):
+            continue
+        vals = [x.strip() for x in row]
+        label = vals[0].lower()
+
+        if not header_done:
+            if label == 'header':
+                doc.header_fields = vals[1:]
+            elif label == 'header data':
+                doc.header_data = vals[1:]
+                header_done = True
+
+        if not batch_done:
+            if label == 'batch header':
+                doc.batch_headers = vals[1:]
+            elif label == 'batch data':
+                doc.batch_data = vals[1:]
+                batch_done = True
+
+        if in_samples:
+            if any(vals):
+                doc.samples.append(vals)
+        elif label == 'samples':
+            doc.sample_headers = vals
+        elif label == 'total analyses or profiles':
+            doc.total_analyses = vals
+            doc.samples = SampleColumns(doc.sample_headers or [])
+            in_samples = True
+    if doc.samples is not None:
+        doc.samples.finish()
+    return doc
@@ -0,0 +1,616 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""Persistent queue of sample imports that run in the background.
+
+The import transition adds a job to the queue and returns at once. The queue
+is a BTree in the ZODB root, so every instance that shares the database sees
+the same jobs and no external broker is needed. Jobs are run by ImportWorker
+threads, started with the process when import_workers is set in zope.conf.
+That can be on the instances that serve requests or on a separate worker
+instance. process_jobs runs the queued jobs in the calling thread, e.g. in
+tests. Imports in chunks that are not queued are queued too, and run by a
+JobThread of the instance once the import transition is committed, so the
+transition is never committed halfway. An import that stopped is queued
+again with SampleImport.resume_import.
+
+The state of a job is recorded in the ImportStatus field of its
+SampleImport. A job stays in the queue until its import is done: a worker
+claims it for import_lease_timeout seconds and a LeaseKeeper thread renews
+the claim while the import runs, in short transactions of its own. The job
+of a worker that died is picked up again when its claim expires and resumes
+from its last checkpoint.
+
+With import_shards set, the rows of an import are split into that many
+shards, each with a job of its own. Shards are claimed like any other job,
+so the workers of all instances that share the database, e.g. the ZEO
+clients of a cluster, create the samples of one import side by side. The
+checkpoint of a shard is kept in an ImportShard in the ZODB root, not in the
+SampleImport, so shards do not conflict with each other. The worker that
+finishes the last shard marks the import done.
+
+With import_threads set, an import that is not queued is split into that
+many shards too. Their jobs are run by JobThreads of the request's process,
+each with its own ZODB connection, once the import transition is committed.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+import transaction
+from AccessControl.SecurityManagement import getSecurityManager
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import setSecurityManager
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from bika.lims import api
+from Testing.makerequest import makerequest
+from ZODB.POSException import ConflictError
+from zope.component.hooks import getSite
+from zope.component.hooks import setSite
+
+from senaite.sampleimporter import logger
+from senaite.sampleimporter.catalogs import get_portal
+from senaite.sampleimporter.settings import get_int_setting
+
+QUEUE_KEY = 'senaite.sampleimporter.jobs'
+SHARDS_KEY = 'senaite.sampleimporter.shards'
+
+# Values of SampleImport.ImportStatus
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def get_queue(context, create=False):
+    """Returns the job queue of the database of the context
+    """
+    root = context._p_jar.root()
+    queue = root.get(QUEUE_KEY)
+    if queue is None and create:
+        queue = root[QUEUE_KEY] = OOBTree()
+    return queue
+
+
+class ImportProgress(object):
+    """Progress of an import of all rows, kept in the fields of the
+    SampleImport
+    """
+
+    def __init__(self, sampleimport):
+        self.sampleimport = sampleimport
+        self.start = 0
+        self.end = len(sampleimport.getSampleData())
+
+    def get_checkpoint(self):
+        return self.sampleimport.getImportCheckpoint() or 0
+
+    def set_checkpoint(self, value):
+        self.sampleimport.setImportCheckpoint(value)
+
+    checkpoint = property(get_checkpoint, set_checkpoint)
+
+    def get_conflicts(self):
+        return self.sampleimport.getImportConflicts() or 0
+
+    def set_conflicts(self, value):
+        self.sampleimport.setImportConflicts(value)
+
+    conflicts = property(get_conflicts, set_conflicts)
+
+    def get_retries(self):
+        return self.sampleimport.getImportRetries() or 0
+
+    def set_retries(self, value):
+        self.sampleimport.setImportRetries(value)
+
+    retries = property(get_retries, set_retries)
+
+    def finish(self):
+        self.sampleimport.setImportStatus(DONE)
+
+
+class ImportShard(Persistent):
+    """Progress of the rows start to end of a sharded import
+    """
+
+    # The services of the Analyses values of all shards, resolved once when
+    # the shards are created
+    services = None
+
+    def __init__(self, uid, nr, start, end):
+        self.uid = uid
+        self.nr = nr
+        self.start = start
+        self.end = end
+        self.checkpoint = start
+        self.conflicts = 0
+        self.retries = 0
+
+    @property
+    def done(self):
+        return self.checkpoint >= self.end
+
+    def finish(self):
+        """The import is marked done by complete_import, once all shards
+        are done
+        """
+        pass
+
+
+def split_rows(nr_rows, nr_shards):
+    """Returns the (start, end) ranges of nr_shards shards of about the
+    same size. There are no empty shards, so there can be fewer
+    """
+    nr_shards = max(1, min(nr_shards, nr_rows))
+    size, rest = divmod(nr_rows, nr_shards)
+    ranges = []
+    start = 0
+    for nr in range(nr_shards):
+        end = start + size + (1 if nr < rest else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def get_shards(context, uid, create=False):
+    """Returns the shards of the import with the uid, a BTree of shard
+    number to ImportShard, or None
+    """
+    root = context._p_jar.root()
+    imports = root.get(SHARDS_KEY)
+    if imports is None:
+        if not create:
+            return None
+        imports = root[SHARDS_KEY] = OOBTree()
+    shards = imports.get(uid)
+    if shards is None and create:
+        shards = imports[uid] = OOBTree()
+    return shards
+
+
+def create_shards(sampleimport, nr_shards):
+    """Split the rows of the SampleImport that are not imported yet into
+    shards. The services of the rows are resolved here, in the current
+    transaction, so invalid values are reported once and the shards do not
+    write to the SampleImport. Returns the shards
+    """
+    uid = sampleimport.UID()
+    start = sampleimport.getImportCheckpoint() or 0
+    gridrows = sampleimport.schema['SampleData'].get(sampleimport)[start:]
+    services = sampleimport.resolve_services(gridrows)
+    shards = get_shards(sampleimport, uid, create=True)
+    shards.clear()
+    for nr, (first, end) in enumerate(split_rows(len(gridrows), nr_shards)):
+        shard = ImportShard(uid, nr, start + first, start + end)
+        shard.services = services
+        shards[nr] = shard
+    return shards
+
+
+def complete_import(app, uid):
+    """Mark a sharded import done when all its shards are done, and remove
+    its shards. Commits and returns True if the import was completed by this
+    call
+    """
+    retries = get_int_setting('import_conflict_retries')
+    for attempt in range(retries + 1):
+        shards = get_shards(app, uid)
+        if shards is None or not all(s.done for s in shards.values()):
+            return False
+        sampleimport = api.get_object_by_uid(uid)
+        finish_shards(sampleimport, shards)
+        try:
+            transaction.commit()
+        except ConflictError:
+            # The last two shards finished at the same time
+            transaction.abort()
+            continue
+        return True
+    return False
+
+
+def finish_shards(sampleimport, shards):
+    """Add up the counters of the done shards in the SampleImport, mark it
+    done and remove its shards, in the current transaction
+    """
+    shards = list(shards.values())
+    sampleimport.setImportCheckpoint(max(s.end for s in shards))
+    sampleimport.setImportConflicts(
+        (sampleimport.getImportConflicts() or 0) +
+        sum(s.conflicts for s in shards))
+    sampleimport.setImportRetries(
+        (sampleimport.getImportRetries() or 0) +
+        sum(s.retries for s in shards))
+    sampleimport.setImportStatus(DONE)
+    del sampleimport._p_jar.root()[SHARDS_KEY][sampleimport.UID()]
+    logger.info("Import of {}: all {} shards done".format(
+        sampleimport.getId(), len(shards)))
+
+
+def enqueue(sampleimport, nr_shards=None):
+    """Add the jobs that create the rows of the SampleImport that are not
+    imported yet, as the current user. With nr_shards > 1, the rows are
+    split into shards with a job each, defaults to import_shards. The shards
+    of an import that stopped are queued again instead, or the import is
+    completed if they are all done. Returns the job ids
+    """
+    portal = get_portal(sampleimport)
+    queue = get_queue(portal, create=True)
+    uid = sampleimport.UID()
+    job = {
+        'uid': uid,
+        'site': '/'.join(portal.getPhysicalPath()),
+        'user': getSecurityManager().getUser().getId(),
+    }
+    jobs = [job]
+    if nr_shards is None:
+        nr_shards = get_int_setting('import_shards')
+    shards = get_shards(sampleimport, uid)
+    if shards:
+        jobs = [dict(job, shard=nr) for nr, shard in shards.items()
+                if not shard.done]
+        if not jobs:
+            # The last shard was done, but the import was not completed
+            finish_shards(sampleimport, shards)
+            return []
+    elif nr_shards > 1:
+        shards = create_shards(sampleimport, nr_shards)
+        jobs = [dict(job, shard=nr) for nr in shards.keys()]
+    job_ids = []
+    for job in jobs:
+        job_id = '{:.6f}-{}'.format(time.time(), uid)
+        if 'shard' in job:
+            job_id += '-{}'.format(job['shard'])
+        queue[job_id] = job
+        job_ids.append(job_id)
+        logger.info("Queued import job {}".format(job_id))
+    sampleimport.setImportStatus(QUEUED)
+    return job_ids
+
+
+def get_jobs(sampleimport):
+    """Returns the (job_id, job) pairs of the queued jobs of the SampleImport
+    """
+    queue = get_queue(sampleimport)
+    if not queue:
+        return []
+    uid = sampleimport.UID()
+    return [(job_id, job) for job_id, job in queue.items()
+            if job['uid'] == uid]
+
+
+def is_claimed(job):
+    """Checks if a worker runs the job and renews its claim
+    """
+    expired = time.time() - get_int_setting('import_lease_timeout')
+    return job.get('claimed', 0) >= expired
+
+
+def drop_jobs(sampleimport):
+    """Remove the queued jobs of the SampleImport
+    """
+    queue = get_queue(sampleimport)
+    for job_id, job in get_jobs(sampleimport):
+        del queue[job_id]
+
+
+def claim_job(app, job_id=None):
+    """Claim the oldest job that is not claimed, or whose claim expired
+    because its worker stopped renewing it, and commit so that no other
+    worker runs it. When another worker claimed the same job at the same
+    time, the next job is tried. With a job_id, only that job is claimed.
+    Returns (job_id, job), or None if there is no job left to claim
+    """
+    wanted = job_id
+    while True:
+        queue = get_queue(app)
+        if not queue:
+            return None
+        if wanted is None:
+            for job_id, job in queue.items():
+                if not is_claimed(job):
+                    break
+            else:
+                return None
+        else:
+            job = queue.get(wanted)
+            if job is None or is_claimed(job):
+                return None
+        if job.get('claimed'):
+            logger.warn("Claim of import job {} expired, resuming it".format(
+                job_id))
+        queue[job_id] = dict(job, claimed=time.time())
+        try:
+            transaction.commit()
+        except ConflictError:
+            # The abort syncs the connection, the job claimed by the other
+            # worker is skipped on the next try
+            transaction.abort()
+            continue
+        logger.info("Claimed import job {}".format(job_id))
+        return job_id, job
+
+
+class LeaseKeeper(threading.Thread):
+    """Thread that renews the claim of a running job every third of the
+    lease timeout, with its own ZODB connection. The import commits no
+    queue changes while it runs, so the renewals do not conflict with it
+    """
+
+    def __init__(self, db, job_id):
+        super(LeaseKeeper, self).__init__(name='sampleimport-lease')
+        self.daemon = True
+        self.db = db
+        self.job_id = job_id
+        self.interval = get_int_setting('import_lease_timeout') / 3.0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.renew()
+            except Exception:
+                logger.exception("Failed to renew the claim of import job "
+                                 "{}".format(self.job_id))
+
+    def renew(self):
+        manager = transaction.TransactionManager()
+        connection = self.db.open(transaction_manager=manager)
+        try:
+            queue = connection.root().get(QUEUE_KEY)
+            job = queue.get(self.job_id) if queue is not None else None
+            if job is not None:
+                queue[self.job_id] = dict(job, claimed=time.time())
+                manager.commit()
+        except ConflictError:
+            # Renewed at the next interval
+            manager.abort()
+        finally:
+            manager.abort()
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def finish_job(app, job_id):
+    """Remove a job from the queue and commit. Done in a transaction of its
+    own, after the import committed its rows
+    """
+    retries = get_int_setting('import_conflict_retries')
+    for attempt in range(retries + 1):
+        queue = get_queue(app)
+        if job_id in queue:
+            del queue[job_id]
+        try:
+            transaction.commit()
+            return
+        except ConflictError:
+            transaction.abort()
+    logger.error("Failed to remove import job {}".format(job_id))
+
+
+def fail_job(app, job_id, job, error):
+    """Mark the import of a job failed and commit. The job is left in the
+    queue with its claim, so it runs again from its last checkpoint when the
+    claim expires, until it failed import_job_attempts times. The shards of
+    an import are kept, so it can be resumed
+    """
+    max_attempts = get_int_setting('import_job_attempts')
+    retries = get_int_setting('import_conflict_retries')
+    for attempt in range(retries + 1):
+        queue = get_queue(app, create=True)
+        queued = queue.get(job_id)
+        if queued is not None:
+            attempts = queued.get('attempts', 0) + 1
+            if attempts < max_attempts:
+                queue[job_id] = dict(queued, attempts=attempts)
+            else:
+                logger.error("Import job {} failed {} times, giving up"
+                             .format(job_id, attempts))
+                del queue[job_id]
+        sampleimport = api.get_object_by_uid(job['uid'])
+        sampleimport.setImportStatus(FAILED)
+        sampleimport.error("Import failed: {}".format(error))
+        try:
+            transaction.commit()
+            return
+        except ConflictError:
+            transaction.abort()
+    logger.error("Failed to record the failure of import job {}".format(
+        job_id))
+
+
+def get_user(site, userid):
+    """Returns the user with the id from the site or the root user folder
+    """
+    for acl_users in (site.acl_users, site.aq_parent.acl_users):
+        user = acl_users.getUserById(userid)
+        if user is not None:
+            return user.__of__(acl_users)
+    return None
+
+
+@contextmanager
+def job_context(app, job):
+    """Run the block on the site of the job, as the user that queued it.
+    Returns the site
+    """
+    old_site = getSite()
+    old_security_manager = getSecurityManager()
+    site = app.unrestrictedTraverse(job['site'])
+    setSite(site)
+    try:
+        newSecurityManager(None, get_user(site, job['user']))
+        yield site
+    finally:
+        setSecurityManager(old_security_manager)
+        setSite(old_site)
+
+
+def run_job(app, job_id, job):
+    """Run the import of a claimed job on the site of the job, as the user
+    that queued it. Imports commit their checkpoints along the way, an
+    interrupted import resumes from the last checkpoint when its claim
+    expires
+    """
+    with job_context(app, job):
+        sampleimport = api.get_object_by_uid(job['uid'], None)
+        if sampleimport is None:
+            logger.warn("SampleImport {} not found [SKIP]".format(job['uid']))
+            finish_job(app, job_id)
+            return
+        shard = None
+        if 'shard' in job:
+            shard = (get_shards(app, job['uid']) or {}).get(job['shard'])
+            if shard is None:
+                # The import was completed while the claim had expired
+                logger.warn("Shard {} of {} not found [SKIP]".format(
+                    job['shard'], job['uid']))
+                finish_job(app, job_id)
+                return
+        lease = LeaseKeeper(app._p_jar.db(), job_id)
+        lease.start()
+        try:
+            try:
+                sampleimport.run_import(progress=shard)
+                transaction.commit()
+            finally:
+                lease.stop()
+        except Exception as e:
+            transaction.abort()
+            logger.exception("Import of {} failed".format(job['uid']))
+            fail_job(app, job_id, job, e)
+            return
+        finish_job(app, job_id)
+        if shard is not None:
+            complete_import(app, job['uid'])
+
+
+def process_jobs(app, limit=None):
+    """Run queued jobs in this thread until no job is left to claim, or
+    limit jobs were run. Returns the number of jobs run
+    """
+    count = 0
+    while limit is None or count < limit:
+        claimed = claim_job(app)
+        if claimed is None:
+            break
+        run_job(app, *claimed)
+        count += 1
+    return count
+
+
+class ImportWorker(threading.Thread):
+    """Thread that polls the job queue with its own ZODB connection
+    """
+
+    def __init__(self, db, interval):
+        super(ImportWorker, self).__init__(name='sampleimport-worker')
+        self.daemon = True
+        self.db = db
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Import worker failed to process jobs")
+            self.stopped.wait(self.interval)
+
+    def poll(self):
+        connection = self.db.open()
+        try:
+            app = makerequest(connection.root()['Application'])
+            process_jobs(app)
+        finally:
+            transaction.abort()
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class JobThread(threading.Thread):
+    """Thread that runs one queued job with its own ZODB connection, unless
+    a worker claimed it first
+    """
+
+    def __init__(self, db, job_id):
+        super(JobThread, self).__init__(name='sampleimport-job')
+        self.db = db
+        self.job_id = job_id
+
+    def run(self):
+        connection = self.db.open()
+        try:
+            app = makerequest(connection.root()['Application'])
+            claimed = claim_job(app, self.job_id)
+            if claimed is not None:
+                run_job(app, *claimed)
+        except Exception:
+            logger.exception("Import job {} failed".format(self.job_id))
+        finally:
+            transaction.abort()
+            connection.close()
+
+
+runners = []
+
+
+def start_jobs(sampleimport, job_ids):
+    """Run the queued jobs in threads of this process once the current
+    transaction, which queued them, is committed
+    """
+    db = sampleimport._p_jar.db()
+
+    def start(status):
+        if not status:
+            return
+        for job_id in job_ids:
+            runner = JobThread(db, job_id)
+            runner.start()
+            runners.append(runner)
+        # Forget the runners that are done
+        runners[:] = [thread for thread in runners if thread.is_alive()]
+
+    transaction.get().addAfterCommitHook(start)
+
+
+workers = []
+
+
+def start_workers(event):
+    """Subscriber of IDatabaseOpenedWithRoot, starts import_workers
+    ImportWorker threads
+    """
+    interval = get_int_setting('import_poll_interval')
+    for i in range(get_int_setting('import_workers')):
+        worker = ImportWorker(event.database, interval)
+        worker.start()
+        workers.append(worker)
+    if workers:
+        logger.info("Started {} import workers".format(len(workers)))
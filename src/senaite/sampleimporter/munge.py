@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""Conversion of spreadsheet cells into field values that does not need the
+catalog, i.e. everything but references.
+
+The functions here only depend on their arguments, so whole columns can be
+converted in a pool of worker processes. The built-in conversions cost less
+than pickling the cells to the workers, so the serial path is the default.
+"""
+
+from datetime import datetime
+from multiprocessing import Pool
+
+from DateTime.DateTime import DateTime
+
+# Field types that are resolved against the catalog
+REFERENCE_TYPES = ('reference', 'uidreference')
+
+# Values of boolean cells that are false
+FALSE_VALUES = ('0', 'no', 'false', 'none')
+
+# Unambiguous date formats that are parsed with strptime instead of the
+# DateTime guesser
+ISO_DATE_FORMATS = (
+    '%Y-%m-%d',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+)
+DATE_FORMATS = ISO_DATE_FORMATS + (
+    '%Y/%m/%d',
+    '%Y/%m/%d %H:%M',
+    '%Y/%m/%d %H:%M:%S',
+)
+
+# DateTime reads ISO 8601 dates without a timezone as GMT+0, and the other
+# formats in the local timezone of the server
+ISO_TIMEZONE = 'GMT+0'
+
+
+def munge_boolean(value):
+    value = str(value).strip().lower()
+    return '' if value in FALSE_VALUES else '1'
+
+
+def munge_datetime(value, date_format=None):
+    """Parse a date cell. With a date_format the fixed format is tried
+    first, DateTime guesses the format of anything else. Both give the same
+    date in the same timezone
+    """
+    if date_format:
+        try:
+            date = datetime.strptime(value, date_format)
+            args = [date.year, date.month, date.day,
+                    date.hour, date.minute, date.second]
+            if date_format in ISO_DATE_FORMATS:
+                args.append(ISO_TIMEZONE)
+            return DateTime(*args)
+        except ValueError:
+            pass
+    return DateTime(value)
+
+
+def detect_date_format(cells):
+    """Returns the first of DATE_FORMATS that matches the first value of a
+    column of date cells, or None
+    """
+    for cell in cells:
+        if not cell:
+            continue
+        for date_format in DATE_FORMATS:
+            try:
+                datetime.strptime(cell, date_format)
+                return date_format
+            except ValueError:
+                continue
+        return None
+    return None
+
+
+def munge_string(value):
+    return str(value)
+
+
+MUNGERS = {
+    'boolean': munge_boolean,
+}
+
+
+def munge_cell(field_type, value, date_format=None):
+    """Convert a cell for a field of the given type. Returns a tuple
+    (value, valid). Datetime cells are returned as DateTime objects, they are
+    localized by the caller
+    """
+    try:
+        if field_type == 'datetime':
+            return munge_datetime(value, date_format), True
+        return MUNGERS.get(field_type, munge_string)(value), True
+    except Exception:
+        return None, False
+
+
+def munge_cells(field_type, cells, date_format=None):
+    """Convert the cells of a column. Empty cells are returned as None.
+    Equal cells are converted once
+    """
+    memo = {}
+    munged = []
+    for cell in cells:
+        if not cell:
+            munged.append(None)
+            continue
+        value = memo.get(cell)
+        if value is None:
+            value = memo[cell] = munge_cell(field_type, cell, date_format)
+        munged.append(value)
+    return munged
+
+
+def munge_task(task):
+    """Entry point of the worker processes
+    """
+    return munge_cells(*task)
+
+
+def munge_columns(columns, processes=0, chunk_size=5000):
+    """Convert columns given as (field type, cells) pairs and return the
+    converted cells of each column, in the same order.
+
+    With processes > 0, the columns are split into chunks of chunk_size
+    cells that are converted by a pool of that many worker processes. The
+    results are merged back in row order. The pool only pays off when the
+    conversion of a cell costs more than pickling it, see munge_processes
+    in the README.
+    """
+    # The date format is detected once per column, so all chunks of a
+    # column are parsed the same way
+    columns = [(field_type, cells,
+                detect_date_format(cells) if field_type == 'datetime'
+                else None)
+               for field_type, cells in columns]
+    if not processes:
+        return [munge_cells(*column) for column in columns]
+
+    tasks = []
+    for field_type, cells, date_format in columns:
+        for start in range(0, len(cells), chunk_size):
+            tasks.append((field_type, cells[start:start + chunk_size],
+                          date_format))
+
+    pool = Pool(processes)
+    try:
+        chunks = iter(pool.map(munge_task, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+    results = []
+    for field_type, cells, date_format in columns:
+        munged = []
+        for start in range(0, len(cells), chunk_size):
+            munged.extend(next(chunks))
+        results.append(munged)
+    return results
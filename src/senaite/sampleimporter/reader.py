@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import csv
+import hashlib
+import mmap
+import os
+import tempfile
+import zlib
+from contextlib import closing
+from contextlib import contextmanager
+from gzip import GzipFile
+from zipfile import BadZipfile
+from zipfile import ZipFile
+from senaite.sampleimporter.spreadsheet import is_workbook
+from senaite.sampleimporter.spreadsheet import iter_workbook_rows
+
+# Number of bytes read from the file handle at once
+CHUNK_SIZE = 1 << 16
+
+# Leading bytes of a zip archive, like XLSX and ODS workbooks
+ZIP_MAGIC = 'PK\x03\x04'
+
+# Leading bytes of a gzip file
+GZIP_MAGIC = '\x1f\x8b'
+
+# Errors raised while reading a corrupt or mislabelled import file. The XML
+# ParseError of workbooks is a SyntaxError, a missing archive member raises
+# KeyError
+READ_ERRORS = (BadZipfile, IOError, EOFError, KeyError, zlib.error,
+               csv.Error, SyntaxError)
+
+
+def iter_lines(fileobj, chunk_size=CHUNK_SIZE):
+    """Yield the lines of a file handle without their line terminators, the
+    same way str.splitlines does, reading chunk_size bytes at a time
+    """
+    tail = ''
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        lines = (tail + chunk).splitlines(True)
+        # The last piece might be incomplete, or a '\r' that is followed by
+        # a '\n' in the next chunk
+        tail = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r\n')
+    if tail:
+        yield tail.rstrip('\r\n')
+
+
+def checksum(fileobj, chunk_size=CHUNK_SIZE):
+    """Returns the SHA-1 hex digest of the contents of a file handle
+    """
+    digest = hashlib.sha1()
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def iter_csv_rows(fileobj):
+    """Yield the rows of a CSV file handle one at a time
+    """
+    return csv.reader(iter_lines(fileobj))
+
+
+def iter_rows(fileobj):
+    """Yield the rows of an import file handle one at a time. The file can be
+
+    - a CSV file
+    - a XLSX/ODS workbook, in which case the rows of its first sheet are
+      returned
+    - a gzip compressed CSV file or workbook
+    - a zip archive with a CSV file
+
+    Compressed files are decompressed while they are read, except gzip
+    compressed workbooks, which are decompressed into a temporary file
+    first. The file handle must be seekable
+    """
+    magic = fileobj.read(len(ZIP_MAGIC))
+    fileobj.seek(0)
+    if magic.startswith(GZIP_MAGIC):
+        decompressed = GzipFile(fileobj=fileobj, mode='rb')
+        inner_magic = decompressed.read(len(ZIP_MAGIC))
+        decompressed.seek(0)
+        if inner_magic == ZIP_MAGIC:
+            # Zip archives are read from their end, which a gzip stream
+            # cannot seek to
+            decompressed = spool_file(decompressed)
+        return iter_rows(decompressed)
+    if magic == ZIP_MAGIC:
+        archive = ZipFile(fileobj)
+        if is_workbook(archive):
+            return iter_workbook_rows(archive)
+        names = [name for name in archive.namelist()
+                 if not name.endswith('/')]
+        if names:
+            return iter_csv_rows(archive.open(names[0]))
+        fileobj.seek(0)
+    return iter_csv_rows(fileobj)
+
+
+def is_compressed(fileobj):
+    """Checks if a seekable file handle holds gzip or zip compressed data
+    """
+    magic = fileobj.read(len(ZIP_MAGIC))
+    fileobj.seek(0)
+    return magic.startswith(GZIP_MAGIC) or magic == ZIP_MAGIC
+
+
+def spool_file(fileobj, chunk_size=CHUNK_SIZE):
+    """Returns a temporary file with the contents of a file handle,
+    positioned at its start
+    """
+    spooled = tempfile.TemporaryFile()
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
+
+
+def gzip_file(fileobj, chunk_size=CHUNK_SIZE):
+    """Returns a temporary file with the gzip compressed contents of a file
+    handle, positioned at its start
+    """
+    compressed = tempfile.TemporaryFile()
+    with closing(GzipFile(fileobj=compressed, mode='wb')) as gzipped:
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            gzipped.write(chunk)
+    compressed.seek(0)
+    return compressed
+
+
+class MappedFile(object):
+    """File handle on a read-only memory map
+    """
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+
+    def __getattr__(self, name):
+        return getattr(self.mapping, name)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.mapping) - self.mapping.tell()
+        return self.mapping.read(size)
+
+
+@contextmanager
+def open_mapped(filename):
+    """Memory-map a file read-only and yield a file handle on the mapping.
+    Readers of the same file share the OS page cache instead of copying the
+    contents into their own heap
+    """
+    with open(filename, 'rb') as fileobj:
+        # Empty files cannot be mapped
+        if not os.fstat(fileobj.fileno()).st_size:
+            yield fileobj
+            return
+        mapping = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield MappedFile(mapping)
+        finally:
+            mapping.close()
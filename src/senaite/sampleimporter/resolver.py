@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+from senaite.sampleimporter.catalogs import get_catalog
+from senaite.sampleimporter.catalogs import get_catalog_id
+
+# Catalog of the setup types, which are few enough to be loaded whole
+SETUP_CATALOG = 'bika_setup_catalog'
+
+# Index types that take a list of values in a query
+LIST_INDEXES = ('FieldIndex', 'KeywordIndex')
+
+
+def as_types(allowed_types):
+    """Returns allowed_types as a sequence of portal types
+    """
+    if type(allowed_types) not in (list, tuple):
+        return [allowed_types]
+    return allowed_types
+
+
+class ReferenceResolver(object):
+    """Resolves the values of reference cells into UIDs for one import.
+
+    The Titles and UIDs of all objects of a portal_type are loaded with a
+    single catalog query the first time the type is needed, so cells are
+    resolved with dictionary lookups. Values without an exact Title match
+    are looked up once with the catalog query of SampleImport.lookup.
+
+    The prefetch methods resolve the distinct values of a column before the
+    rows are processed, so that no catalog queries are done per row. Only
+    the setup types are loaded whole, other types, e.g. Contact, Batch or
+    AnalysisRequest, are queried for the values of the column only.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.queries = 0
+        self._titles = {}
+        self._uids = {}
+        self._searched = {}
+        self._found_uids = {}
+        self._checked_uids = {}
+        self._found_titles = {}
+        self._checked_titles = {}
+
+    def load(self, portal_type):
+        """Load the Title and UID maps of a portal_type
+        """
+        if portal_type in self._uids:
+            return
+        catalog = get_catalog(self.context, portal_type)
+        titles = {}
+        uids = set()
+        for brain in catalog(portal_type=portal_type):
+            titles.setdefault(brain.Title, []).append(brain.UID)
+            uids.add(brain.UID)
+        self.queries += 1
+        self._titles[portal_type] = titles
+        self._uids[portal_type] = uids
+
+    def by_title(self, allowed_types, value):
+        """Returns the UIDs of the objects of the first of allowed_types
+        that have the given Title. The objects of a type are only loaded if
+        the value was not checked by prefetch
+        """
+        for portal_type in as_types(allowed_types):
+            if portal_type not in self._titles and \
+                    value in self._checked_titles.get(portal_type, ()):
+                uids = self._found_titles[portal_type].get(value)
+            else:
+                self.load(portal_type)
+                uids = self._titles[portal_type].get(value)
+            if uids:
+                return uids
+        return []
+
+    def by_uid(self, allowed_types, value):
+        """Returns [value] if it is the UID of an object of allowed_types.
+        The objects of a type are only loaded if the value was not checked
+        by prefetch_uids, a prefetched UID that was not found is no match
+        """
+        allowed_types = as_types(allowed_types)
+        for portal_type in allowed_types:
+            if value in self._found_uids.get(portal_type, ()):
+                return [value]
+            if value in self._uids.get(portal_type, ()):
+                return [value]
+        for portal_type in allowed_types:
+            if value in self._checked_uids.get(portal_type, ()):
+                continue
+            self.load(portal_type)
+            if value in self._uids[portal_type]:
+                return [value]
+        return []
+
+    def resolve(self, allowed_types, value):
+        """Returns the UIDs of the objects of allowed_types that have the
+        value as Title, or else as UID
+        """
+        allowed_types = as_types(allowed_types)
+        return (self.by_title(allowed_types, value) or
+                self.by_uid(allowed_types, value) or
+                self.search(allowed_types, value))
+
+    def search(self, allowed_types, value):
+        """Search the Title index for values without an exact match, once
+        per value
+        """
+        key = (tuple(allowed_types), value)
+        if key not in self._searched:
+            brains = self.context.lookup(allowed_types, Title=value)
+            self.queries += 1
+            self._searched[key] = [b.UID for b in brains] if brains else []
+        return self._searched[key]
+
+    def prefetch(self, allowed_types, values):
+        """Resolve the distinct values of a reference column by Title or UID.
+        The objects of setup types are loaded, the other types are queried
+        for the values only
+        """
+        allowed_types = as_types(allowed_types)
+        values = set(str(v).strip() for v in values if v)
+        if not values:
+            return
+        for portal_type in allowed_types:
+            if get_catalog_id(self.context, portal_type) == SETUP_CATALOG:
+                self.load(portal_type)
+            else:
+                self.prefetch_titles(portal_type, values)
+                self.prefetch_uids(portal_type, values)
+        for value in values:
+            self.resolve(allowed_types, value)
+
+    def prefetch_titles(self, portal_type, titles):
+        """Check the distinct Titles of a column with one catalog query, or
+        one query per Title if the Title index does not take a list
+        """
+        checked = self._checked_titles.setdefault(portal_type, set())
+        titles = set(titles) - checked
+        if not titles or portal_type in self._titles:
+            return
+        catalog = get_catalog(self.context, portal_type)
+        index = catalog._catalog.indexes.get('Title')
+        if getattr(index, 'meta_type', None) in LIST_INDEXES:
+            brains = catalog(portal_type=portal_type, Title=list(titles))
+            self.queries += 1
+        else:
+            brains = []
+            for title in titles:
+                brains.extend(self.context.lookup(
+                    [portal_type], Title=title) or [])
+                self.queries += 1
+        found = self._found_titles.setdefault(portal_type, {})
+        for brain in brains:
+            if brain.Title in titles:
+                found.setdefault(brain.Title, []).append(brain.UID)
+        checked.update(titles)
+
+    def prefetch_uids(self, allowed_types, values):
+        """Check the distinct UIDs of a column with one catalog query per
+        portal_type, without loading all objects of the type
+        """
+        uids = set(str(v).strip() for v in values if v)
+        for portal_type in as_types(allowed_types):
+            if not uids or portal_type in self._uids:
+                continue
+            catalog = get_catalog(self.context, portal_type)
+            brains = catalog(portal_type=portal_type, UID=list(uids))
+            self.queries += 1
+            self._checked_uids.setdefault(portal_type, set()).update(uids)
+            found = set(b.UID for b in brains)
+            self._found_uids.setdefault(portal_type, set()).update(found)
+            uids -= found
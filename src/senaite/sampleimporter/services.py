@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""In-memory index of the analysis services and profiles of a site.
+
+The importer accepts services by keyword, title or UID and profiles by
+profile key, title or UID. The index maps all of them to UIDs, and every
+profile to the frozen set of its service UIDs, so rows are expanded without
+catalog queries or waking profile objects.
+
+The index of a site is built on first use and kept for the process. It is
+never updated in place. The subscribers below count the changes of services
+and profiles in a counter in the ZODB root, in the transaction that does the
+change, and the index is built again in full when the counter differs from
+the one it was built at. So an aborted change is never seen and a change
+committed on another ZEO client is seen by all of them. An index built in a
+transaction that changed a service or profile is not kept, the change is
+not committed yet.
+"""
+
+import threading
+
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+
+from senaite.sampleimporter.catalogs import get_catalog
+from senaite.sampleimporter.catalogs import get_portal
+
+VERSIONS_KEY = 'senaite.sampleimporter.services'
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+class TokenView(object):
+    """Container view of the keys of several mappings
+    """
+
+    def __init__(self, *mappings):
+        self.mappings = mappings
+
+    def __contains__(self, token):
+        return any(token in mapping for mapping in self.mappings)
+
+
+class ServiceIndex(object):
+    """Tokens of the analysis services and profiles of a site
+    """
+
+    def __init__(self):
+        # service keyword/title/UID -> service UID
+        self.keywords = {}
+        self.service_titles = {}
+        self.service_uids = set()
+        # profile key/title/UID -> profile UID
+        self.profile_keys = {}
+        self.profile_titles = {}
+        self.profile_uids = set()
+        # profile UID -> frozenset of service UIDs
+        self.profile_services = {}
+        # sample header tokens of profiles
+        self.profile_tokens = TokenView(self.profile_keys, self.profile_titles)
+        # Change counter of the site the index was built at
+        self.version = 0
+
+    def build(self, context):
+        """Load all services and profiles from the catalog
+        """
+        catalog = get_catalog(context, 'AnalysisService')
+        for brain in catalog(portal_type='AnalysisService'):
+            self.add_service(brain.getObject())
+        catalog = get_catalog(context, 'AnalysisProfile')
+        for brain in catalog(portal_type='AnalysisProfile'):
+            self.add_profile(brain.getObject())
+
+    def add_service(self, service):
+        uid = service.UID()
+        keyword = service.getKeyword()
+        title = service.Title()
+        if keyword:
+            self.keywords[keyword] = uid
+        if title:
+            self.service_titles.setdefault(title, uid)
+        self.service_uids.add(uid)
+
+    def add_profile(self, profile):
+        uid = profile.UID()
+        key = profile.getProfileKey()
+        title = profile.Title()
+        if key:
+            self.profile_keys.setdefault(key, uid)
+        if title:
+            self.profile_titles.setdefault(title, uid)
+        self.profile_uids.add(uid)
+        self.profile_services[uid] = frozenset(
+            service.UID() for service in profile.getService())
+
+    def is_keyword(self, token):
+        return token in self.keywords
+
+    def is_profile(self, token):
+        """Checks if the token is the key or title of a profile
+        """
+        return token in self.profile_tokens
+
+    def get_service_uid(self, token):
+        """Returns the UID of the service with the keyword, title or UID
+        """
+        uid = self.keywords.get(token) or self.service_titles.get(token)
+        if uid is None and token in self.service_uids:
+            uid = token
+        return uid
+
+    def get_profile_uid(self, token):
+        """Returns the UID of the profile with the profile key, UID or title
+        """
+        if token in self.profile_uids:
+            return token
+        return self.profile_keys.get(token) or self.profile_titles.get(token)
+
+    def get_services_of_profile(self, token):
+        """Returns the frozen set of service UIDs of the profile, or None
+        """
+        uid = self.get_profile_uid(token)
+        if uid is None:
+            return None
+        return self.profile_services.get(uid, frozenset())
+
+
+def get_version(site):
+    """Returns the change counter of the services and profiles of the site,
+    and whether it was changed in the current transaction
+    """
+    versions = site._p_jar.root().get(VERSIONS_KEY)
+    if versions is None:
+        return 0, False
+    counter = versions.get('/'.join(site.getPhysicalPath()))
+    if counter is None:
+        return 0, False
+    changed = bool(counter._p_changed) or counter._p_jar is None
+    return counter(), changed
+
+
+def get_service_index(context):
+    """Returns the ServiceIndex of the site of the context, built again
+    when a service or profile was changed since it was built
+    """
+    site = get_portal(context)
+    key = '/'.join(site.getPhysicalPath())
+    version, changed = get_version(site)
+    index = _indexes.get(key)
+    if index is not None and index.version == version and not changed:
+        return index
+    with _lock:
+        index = _indexes.get(key)
+        if index is not None and index.version == version and not changed:
+            return index
+        index = ServiceIndex()
+        index.build(site)
+        index.version = version
+        if not changed:
+            _indexes[key] = index
+    return index
+
+
+def invalidate_service_indexes():
+    """Drop the service indexes of all sites
+    """
+    with _lock:
+        _indexes.clear()
+
+
+def object_changed(obj, event):
+    """Subscriber for added, modified and removed analysis services and
+    profiles. Counts the change, the index is built again on next use
+    """
+    site = get_portal(obj)
+    root = site._p_jar.root()
+    versions = root.get(VERSIONS_KEY)
+    if versions is None:
+        versions = root[VERSIONS_KEY] = OOBTree()
+    key = '/'.join(site.getPhysicalPath())
+    counter = versions.get(key)
+    if counter is None:
+        counter = versions[key] = Length()
+    counter.change(1)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""Process-level settings of the importer, read from zope.conf:
+
+    <product-config senaite.sampleimporter>
+        compress_uploads on
+    </product-config>
+
+With buildout, add the section to the zope-conf-additional option of the
+instance part.
+"""
+
+from App.config import getConfiguration
+from senaite.sampleimporter import PRODUCT_NAME
+
+TRUE_VALUES = ('1', 'on', 'true', 'yes')
+
+DEFAULTS = {
+    # Store uploaded import files gzip-compressed in the blob storage
+    'compress_uploads': 'off',
+    # Number of worker processes that convert the sample columns of an
+    # import. 0 converts them in the request thread, which is faster for
+    # the built-in conversions
+    'munge_processes': '0',
+    # Number of cells of a column sent to a worker process at once
+    'munge_chunk_size': '5000',
+    # Queue the import transition as a background job instead of creating
+    # the samples in the request
+    'import_queue': 'off',
+    # Number of threads of this instance that run queued imports
+    'import_workers': '0',
+    # Seconds between two polls of the job queue by a worker
+    'import_poll_interval': '5',
+    # Number of rows created per transaction by an import, 0 creates all
+    # rows in one transaction
+    'import_chunk_size': '0',
+    # Seconds after which the job of a worker that stopped renewing its
+    # claim is given to another worker
+    'import_lease_timeout': '600',
+    # Number of times a chunk of rows is tried again after a ConflictError
+    'import_conflict_retries': '3',
+    # Milliseconds to wait before the first retry, doubled for every retry
+    'import_retry_backoff': '500',
+    # Number of times a failed job is run again, when its claim expires,
+    # before it is removed from the queue
+    'import_job_attempts': '3',
+    # Number of shards the rows of a queued import are split into, each run
+    # as a job of its own by any worker that shares the database
+    'import_shards': '1',
+    # Number of threads that create the rows of an import that is not
+    # queued, each with its own ZODB connection. 0 creates them in the
+    # request thread
+    'import_threads': '0',
+}
+
+
+def get_setting(name):
+    """Returns the raw (string) value of a setting
+    """
+    config = getattr(getConfiguration(), 'product_config', None) or {}
+    values = config.get(PRODUCT_NAME) or {}
+    return values.get(name, DEFAULTS.get(name))
+
+
+def get_bool_setting(name):
+    """Returns the value of a setting as a boolean
+    """
+    return str(get_setting(name)).strip().lower() in TRUE_VALUES
+
+
+def get_int_setting(name):
+    """Returns the value of a setting as an integer
+    """
+    return int(get_setting(name))
@@ -48,6 +48,19 @@ ID_FORMATTING = [
 WORKFLOWS_TO_UPDATE = {
 }
 
+INDEXES = [
+    # Tuples of (catalog, index_name, index_type)
+    # Uniqueness checks of SampleImport header values
+    ("portal_catalog", "getClientOrderNumber", "FieldIndex"),
+    ("portal_catalog", "getClientReference", "FieldIndex"),
+]
+
+COLUMNS = [
+    # Tuples of (catalog, column_name)
+    ("portal_catalog", "getClientOrderNumber"),
+    ("portal_catalog", "getClientReference"),
+]
+
 
 def pre_install(portal_setup):
     """Runs before the first import step of the *default* profile
@@ -82,7 +95,7 @@ def post_install(portal_setup):
     client_fti.allowed_content_types = allowed_types
 
     # Setup catalogs
-    # setup_catalogs(portal)
+    setup_catalogs(portal)
 
     # Reindex new content types
     reindex_new_content_types(portal)
@@ -100,6 +113,41 @@ def post_install(portal_setup):
     logger.info("{} install handler [DONE]".format(PRODUCT_NAME.upper()))
 
 
+def setup_catalogs(portal):
+    """Adds the indexes and metadata columns of the sampleimporter and
+    reindexes the existing SampleImport objects if needed
+    """
+    logger.info("Setup catalogs ...")
+    to_reindex = set()
+    for catalog_id, name, meta_type in INDEXES:
+        catalog = api.get_tool(catalog_id)
+        if name in catalog.indexes():
+            logger.info("Index '{}' already in '{}' [SKIP]"
+                        .format(name, catalog_id))
+            continue
+        logger.info("Adding index '{}' ({}) to '{}'"
+                    .format(name, meta_type, catalog_id))
+        catalog.addIndex(name, meta_type)
+        to_reindex.add(catalog_id)
+
+    for catalog_id, name in COLUMNS:
+        catalog = api.get_tool(catalog_id)
+        if name in catalog.schema():
+            logger.info("Column '{}' already in '{}' [SKIP]"
+                        .format(name, catalog_id))
+            continue
+        logger.info("Adding column '{}' to '{}'".format(name, catalog_id))
+        catalog.addColumn(name)
+        to_reindex.add(catalog_id)
+
+    for catalog_id in to_reindex:
+        catalog = api.get_tool(catalog_id)
+        logger.info("Reindexing SampleImport objects in '{}' ..."
+                    .format(catalog_id))
+        for brain in catalog(portal_type="SampleImport"):
+            brain.getObject().reindexObject()
+
+
 def reindex_new_content_types(portal):
     """Setup new content types"""
     logger.info("*** Reindex new content types ***")
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""Row streaming readers for XLSX (Office Open XML) and ODS (OpenDocument)
+workbooks.
+
+Only the first worksheet is read. The sheet XML is parsed incrementally and
+every row is discarded once it has been yielded, so memory use does not
+depend on the number of rows. Cells are returned as byte strings, the same
+way the csv module returns them, and date cells are written in ISO format so
+that DateTime parses them without guessing.
+"""
+
+import posixpath
+import re
+from datetime import datetime
+from datetime import timedelta
+
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:  # pragma: no cover
+    from xml.etree.ElementTree import iterparse
+
+ODS_MIMETYPE = 'application/vnd.oasis.opendocument.spreadsheet'
+
+# Number formats that Excel defines for dates and times
+XLSX_DATE_FORMATS = frozenset(
+    range(14, 23) + range(27, 37) + range(45, 48) + range(50, 59))
+
+# Literal text, colors/locales and escaped characters in a number format
+XLSX_FORMAT_LITERALS = re.compile(r'"[^"]*"|\[[^\]]*\]|\\.|_.|\*.')
+XLSX_DATE_TOKENS = re.compile(r'[dmyhs]', re.I)
+
+XLSX_EPOCH = datetime(1899, 12, 30)
+XLSX_EPOCH_1904 = datetime(1904, 1, 1)
+
+ODS_TABLE = 'urn:oasis:names:tc:opendocument:xmlns:table:1.0'
+ODS_OFFICE = 'urn:oasis:names:tc:opendocument:xmlns:office:1.0'
+ODS_TEXT = 'urn:oasis:names:tc:opendocument:xmlns:text:1.0'
+ODS_MAX_REPEAT = 1000
+
+
+def local_name(tag):
+    """Strip the namespace from an element tag
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+def to_str(value):
+    """Encode unicode values to UTF-8, like the csv module returns them
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def format_datetime(value):
+    """Returns the ISO representation of a datetime, without the time part
+    for dates at midnight
+    """
+    if (value.hour, value.minute, value.second) == (0, 0, 0):
+        return value.strftime('%Y-%m-%d')
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def is_workbook(zipfile):
+    """Checks if the zip archive is a XLSX or ODS workbook
+    """
+    names = zipfile.namelist()
+    if 'xl/workbook.xml' in names:
+        return True
+    if 'mimetype' in names:
+        return zipfile.read('mimetype').strip() == ODS_MIMETYPE
+    return False
+
+
+def iter_workbook_rows(zipfile):
+    """Yield the rows of the first sheet of a XLSX or ODS workbook
+    """
+    if 'xl/workbook.xml' in zipfile.namelist():
+        return iter_xlsx_rows(zipfile)
+    return iter_ods_rows(zipfile)
+
+
+def column_index(ref):
+    """Returns the 0-based column index of a cell reference like "AB12"
+    """
+    index = 0
+    for char in ref:
+        if char.isdigit():
+            break
+        index = index * 26 + ord(char.upper()) - 64
+    return index - 1
+
+
+def text_of(element):
+    """Returns the text of a XLSX rich text element ("si" or "is"), without
+    phonetic runs
+    """
+    parts = []
+    for node in element:
+        name = local_name(node.tag)
+        if name == 't':
+            parts.append(node.text or '')
+        elif name == 'r':
+            parts.extend(t.text or '' for t in node if local_name(t.tag) == 't')
+    return ''.join(parts)
+
+
+def read_xlsx_workbook(zipfile):
+    """Returns the path of the first worksheet and whether the workbook uses
+    the 1904 date system
+    """
+    rels = {}
+    with zipfile.open('xl/_rels/workbook.xml.rels') as fileobj:
+        for event, element in iterparse(fileobj):
+            if local_name(element.tag) == 'Relationship':
+                rels[element.get('Id')] = element.get('Target')
+
+    sheet = None
+    date1904 = False
+    with zipfile.open('xl/workbook.xml') as fileobj:
+        for event, element in iterparse(fileobj):
+            name = local_name(element.tag)
+            if name == 'workbookPr':
+                date1904 = element.get('date1904') in ('1', 'true')
+            elif name == 'sheet' and sheet is None:
+                rid = [v for k, v in element.items()
+                       if local_name(k) == 'id']
+                sheet = rels.get(rid[0]) if rid else None
+
+    if not sheet:
+        sheet = 'worksheets/sheet1.xml'
+    if sheet.startswith('/'):
+        sheet = sheet[1:]
+    else:
+        sheet = posixpath.normpath(posixpath.join('xl', sheet))
+    return sheet, date1904
+
+
+def read_xlsx_shared_strings(zipfile):
+    """Returns the shared strings table of a XLSX workbook
+    """
+    strings = []
+    if 'xl/sharedStrings.xml' not in zipfile.namelist():
+        return strings
+    with zipfile.open('xl/sharedStrings.xml') as fileobj:
+        for event, element in iterparse(fileobj):
+            if local_name(element.tag) == 'si':
+                strings.append(to_str(text_of(element)))
+                element.clear()
+    return strings
+
+
+def read_xlsx_date_styles(zipfile):
+    """Returns the set of cell style indexes that format numbers as dates
+    """
+    dates = set()
+    if 'xl/styles.xml' not in zipfile.namelist():
+        return dates
+    custom = {}
+    xf_index = 0
+    in_cell_xfs = False
+    with zipfile.open('xl/styles.xml') as fileobj:
+        for event, element in iterparse(fileobj, events=('start', 'end')):
+            name = local_name(element.tag)
+            if name == 'cellXfs':
+                in_cell_xfs = event == 'start'
+            elif event != 'end':
+                continue
+            elif name == 'numFmt':
+                code = XLSX_FORMAT_LITERALS.sub(
+                    '', element.get('formatCode', ''))
+                custom[int(element.get('numFmtId'))] = bool(
+                    XLSX_DATE_TOKENS.search(code))
+            elif name == 'xf' and in_cell_xfs:
+                fmt = int(element.get('numFmtId', 0))
+                if custom.get(fmt, fmt in XLSX_DATE_FORMATS):
+                    dates.add(xf_index)
+                xf_index += 1
+    return dates
+
+
+def xlsx_cell_value(cell, strings, date_styles, epoch):
+    """Returns the value of a XLSX "c" element as a string
+    """
+    cell_type = cell.get('t', 'n')
+    value = None
+    for node in cell:
+        name = local_name(node.tag)
+        if name == 'is' and cell_type == 'inlineStr':
+            return to_str(text_of(node))
+        if name == 'v':
+            value = node.text
+            break
+    if value is None:
+        return ''
+    if cell_type == 's':
+        return strings[int(value)]
+    if cell_type == 'b':
+        return 'TRUE' if value == '1' else 'FALSE'
+    if cell_type == 'n' and int(cell.get('s', 0)) in date_styles:
+        try:
+            serial = float(value)
+            if serial < 1:
+                date = XLSX_EPOCH + timedelta(seconds=round(serial * 86400))
+                return date.strftime('%H:%M:%S')
+            date = epoch + timedelta(seconds=round(serial * 86400))
+            return format_datetime(date)
+        except (ValueError, OverflowError):
+            pass
+    return to_str(value)
+
+
+def iter_xlsx_rows(zipfile):
+    """Yield the rows of the first worksheet of a XLSX workbook
+    """
+    sheet, date1904 = read_xlsx_workbook(zipfile)
+    epoch = XLSX_EPOCH_1904 if date1904 else XLSX_EPOCH
+    strings = read_xlsx_shared_strings(zipfile)
+    date_styles = read_xlsx_date_styles(zipfile)
+
+    with zipfile.open(sheet) as fileobj:
+        sheet_data = None
+        for event, element in iterparse(fileobj, events=('start', 'end')):
+            name = local_name(element.tag)
+            if event == 'start':
+                if name == 'sheetData':
+                    sheet_data = element
+                continue
+            if name != 'row':
+                continue
+            row = []
+            for cell in element:
+                if local_name(cell.tag) != 'c':
+                    continue
+                ref = cell.get('r')
+                index = column_index(ref) if ref else len(row)
+                if index > len(row):
+                    row.extend([''] * (index - len(row)))
+                row.append(
+                    xlsx_cell_value(cell, strings, date_styles, epoch))
+            yield row
+            # Drop the rows that were read already
+            if sheet_data is not None:
+                sheet_data.clear()
+            else:
+                element.clear()
+
+
+def ods_attr(element, namespace, name, default=None):
+    return element.get('{%s}%s' % (namespace, name), default)
+
+
+def ods_text(element):
+    """Returns the text of an ODS text element and its children
+    """
+    parts = [element.text or '']
+    for child in element:
+        name = local_name(child.tag)
+        if name == 's':
+            parts.append(' ' * int(ods_attr(child, ODS_TEXT, 'c', 1)))
+        elif name == 'tab':
+            parts.append('\t')
+        else:
+            parts.append(ods_text(child))
+        parts.append(child.tail or '')
+    return ''.join(parts)
+
+
+def ods_cell_text(cell):
+    """Returns the displayed text of an ODS cell
+    """
+    return '\n'.join(
+        ods_text(p) for p in cell if local_name(p.tag) == 'p')
+
+
+def ods_cell_value(cell):
+    """Returns the value of an ODS table-cell element as a string
+    """
+    value_type = ods_attr(cell, ODS_OFFICE, 'value-type')
+    if value_type in ('float', 'percentage', 'currency'):
+        return to_str(ods_attr(cell, ODS_OFFICE, 'value', ''))
+    if value_type == 'boolean':
+        value = ods_attr(cell, ODS_OFFICE, 'boolean-value', '')
+        return 'TRUE' if value.lower() == 'true' else 'FALSE'
+    if value_type == 'date':
+        value = ods_attr(cell, ODS_OFFICE, 'date-value', '')
+        for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+            try:
+                return format_datetime(datetime.strptime(value[:19], fmt))
+            except ValueError:
+                continue
+    return to_str(ods_cell_text(cell))
+
+
+def iter_ods_rows(zipfile):
+    """Yield the rows of the first table of an ODS workbook
+    """
+    with zipfile.open('content.xml') as fileobj:
+        table = None
+        for event, element in iterparse(fileobj, events=('start', 'end')):
+            name = local_name(element.tag)
+            if event == 'start':
+                if name == 'table' and table is None:
+                    table = element
+                continue
+            if name == 'table' and element is table:
+                break
+            if name != 'table-row' or table is None:
+                continue
+            row = []
+            # Repeated empty cells are only added when followed by a value,
+            # sheets are usually padded with them up to the last column
+            empty = 0
+            for cell in element:
+                if local_name(cell.tag) not in ('table-cell',
+                                                'covered-table-cell'):
+                    continue
+                repeat = int(ods_attr(
+                    cell, ODS_TABLE, 'number-columns-repeated', 1))
+                value = ods_cell_value(cell)
+                if not value:
+                    empty += repeat
+                    continue
+                row.extend([''] * empty)
+                empty = 0
+                row.extend([value] * min(repeat, ODS_MAX_REPEAT))
+            repeat = int(ods_attr(
+                element, ODS_TABLE, 'number-rows-repeated', 1))
+            for i in range(min(repeat, ODS_MAX_REPEAT) if row else 1):
+                yield list(row)
+            element.clear()
+            # Drop the rows that were read already
+            table.clear()
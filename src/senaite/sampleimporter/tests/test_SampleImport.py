@@ -29,7 +29,11 @@ from plone.app.testing import (TEST_USER_ID, TEST_USER_NAME,
                                TEST_USER_PASSWORD, login, setRoles)
 from Products.CMFCore.utils import getToolByName
 from Products.CMFPlone.utils import _createObjectByType
+from senaite.sampleimporter import jobs
+from senaite.sampleimporter.content.sampleimport import SampleImport
+from senaite.sampleimporter import settings
 from senaite.sampleimporter.tests.base import SimpleTestCase
+from ZODB.POSException import ConflictError
 
 try:
     import unittest2 as unittest
@@ -162,6 +166,316 @@ Samples,ClientSampleID,SamplingDate,DateSampled,SamplePoint,SampleMatrix,SampleT
         if states != ['registered'] * 12:
             self.fail('Analysis states should all be registered, but are not!')
 
+    def create_valid_import(self):
+        """Returns a validated SampleImport of two samples
+        """
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        client = self.portal.clients.objectValues()[0]
+        sampleimport = self.addthing(client, 'SampleImport')
+        sampleimport.unmarkCreationFlag()
+        sampleimport.setFilename("test1.csv")
+        sampleimport.setOriginalFile("""
+Header,File name,Client name,Client ID,Contact,CC Names - Report,CC Emails - Report,CC Names - Invoice,CC Emails - Invoice,No of Samples,Client Order Number,Client Reference,,
+Header Data,test1.csv,Happy Hills,HH,Rita Mohale,,,,,2,HHPO-002,,,
+Samples,ClientSampleID,SamplingDate,DateSampled,SamplePoint,SampleMatrix,SampleType,ContainerType,Total number of Analyses or Profiles,Price excl Tax,ECO,SAL,COL,TAS,MicroBio,Properties
+"Total Analyses or Profiles",,,,,,,,,,,,,9,,,
+"Sample 1",HHS14001,,3/9/2014,Toilet,Liquid,Water,Cup,1,0,1,0,0,0,0,0
+"Sample 2",HHS14002,,3/9/2014,Toilet,Liquid,Water,Cup,1,0,0,0,0,0,1,0
+        """)
+        sampleimport.setErrors([])
+        sampleimport.save_header_data()
+        sampleimport.save_sample_data()
+        sampleimport.REQUEST.response.write = lambda x: x
+        workflow.doActionFor(sampleimport, 'validate')
+        return sampleimport
+
+    def test_duplicate_client_order_number(self):
+        first = self.create_valid_import()
+        self.assertFalse(first.getErrors())
+        second = self.create_valid_import()
+        self.assertEqual(
+            list(second.getErrors()),
+            ['ClientOrderNumber: already used by existing SampleImport.'])
+
+    def test_queued_import(self):
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        sampleimport = self.create_valid_import()
+
+        settings.DEFAULTS['import_queue'] = 'on'
+        try:
+            workflow.doActionFor(sampleimport, 'import')
+        finally:
+            settings.DEFAULTS['import_queue'] = 'off'
+        self.assertEqual(sampleimport.getImportStatus(), jobs.QUEUED)
+        barc = getToolByName(self.portal, CATALOG_ANALYSIS_REQUEST_LISTING)
+        self.assertEqual(len(barc(portal_type='AnalysisRequest')), 0)
+
+        # Run the job with a local in-process worker
+        transaction.commit()
+        self.assertEqual(jobs.process_jobs(self.portal.aq_parent), 1)
+        self.assertEqual(sampleimport.getImportStatus(), jobs.DONE)
+        self.assertEqual(len(barc(portal_type='AnalysisRequest')), 2)
+
+    def test_chunked_import_runs_after_commit(self):
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        sampleimport = self.create_valid_import()
+        barc = getToolByName(self.portal, CATALOG_ANALYSIS_REQUEST_LISTING)
+
+        settings.DEFAULTS['import_chunk_size'] = '1'
+        try:
+            workflow.doActionFor(sampleimport, 'import')
+            # Nothing is committed during the transition
+            self.assertEqual(sampleimport.getImportStatus(), jobs.QUEUED)
+            self.assertEqual(len(barc(portal_type='AnalysisRequest')), 0)
+            transaction.commit()
+            for runner in list(jobs.runners):
+                runner.join()
+        finally:
+            settings.DEFAULTS['import_chunk_size'] = '0'
+        transaction.begin()
+        self.assertEqual(sampleimport.getImportStatus(), jobs.DONE)
+        self.assertEqual(len(barc(portal_type='AnalysisRequest')), 2)
+
+    def test_resume_import(self):
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        sampleimport = self.create_valid_import()
+        self.assertFalse(sampleimport.can_resume_import())
+        app = self.portal.aq_parent
+
+        settings.DEFAULTS['import_queue'] = 'on'
+        try:
+            workflow.doActionFor(sampleimport, 'import')
+            # The job got lost and the import failed
+            jobs.drop_jobs(sampleimport)
+            sampleimport.setImportStatus(jobs.FAILED)
+            transaction.commit()
+            self.assertTrue(sampleimport.can_resume_import())
+            sampleimport.resume_import()
+            transaction.commit()
+            claimed = jobs.claim_job(app)
+            # A running import is not resumed
+            self.assertFalse(sampleimport.can_resume_import())
+            jobs.run_job(app, *claimed)
+        finally:
+            settings.DEFAULTS['import_queue'] = 'off'
+        self.assertEqual(sampleimport.getImportStatus(), jobs.DONE)
+        self.assertFalse(sampleimport.can_resume_import())
+        barc = getToolByName(self.portal, CATALOG_ANALYSIS_REQUEST_LISTING)
+        self.assertEqual(len(barc(portal_type='AnalysisRequest')), 2)
+
+    def test_resume_checkpointed_import(self):
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        sampleimport = self.create_valid_import()
+        app = self.portal.aq_parent
+
+        settings.DEFAULTS['import_queue'] = 'on'
+        try:
+            workflow.doActionFor(sampleimport, 'import')
+            # The worker died after the last checkpoint was committed
+            jobs.drop_jobs(sampleimport)
+            sampleimport.setImportCheckpoint(2)
+            sampleimport.setImportStatus(jobs.RUNNING)
+            transaction.commit()
+            self.assertTrue(sampleimport.can_resume_import())
+            sampleimport.resume_import()
+            transaction.commit()
+            jobs.run_job(app, *jobs.claim_job(app))
+        finally:
+            settings.DEFAULTS['import_queue'] = 'off'
+        self.assertEqual(sampleimport.getImportStatus(), jobs.DONE)
+        self.assertEqual(jobs.get_jobs(sampleimport), [])
+        barc = getToolByName(self.portal, CATALOG_ANALYSIS_REQUEST_LISTING)
+        self.assertEqual(len(barc(portal_type='AnalysisRequest')), 0)
+
+    def test_sharded_import(self):
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        sampleimport = self.create_valid_import()
+
+        settings.DEFAULTS['import_queue'] = 'on'
+        settings.DEFAULTS['import_shards'] = '2'
+        try:
+            workflow.doActionFor(sampleimport, 'import')
+        finally:
+            settings.DEFAULTS['import_queue'] = 'off'
+            settings.DEFAULTS['import_shards'] = '1'
+        shards = jobs.get_shards(self.portal, sampleimport.UID())
+        self.assertEqual([(s.start, s.end) for s in shards.values()],
+                         [(0, 1), (1, 2)])
+
+        # The services are resolved once, for all shards
+        services = shards[0].services
+        self.assertTrue(services)
+        self.assertTrue(shards[1].services is services)
+
+        # Each shard is a job, the last one done completes the import
+        transaction.commit()
+        app = self.portal.aq_parent
+        calls = []
+        resolve_services_orig = SampleImport.resolve_services
+
+        def resolve_services(self, rows):
+            calls.append(rows)
+            return resolve_services_orig(self, rows)
+
+        SampleImport.resolve_services = resolve_services
+        try:
+            self.assertEqual(jobs.process_jobs(app, limit=1), 1)
+            self.assertEqual(sampleimport.getImportStatus(), jobs.QUEUED)
+            self.assertEqual(jobs.process_jobs(app), 1)
+        finally:
+            SampleImport.resolve_services = resolve_services_orig
+        self.assertEqual(calls, [])
+        self.assertEqual(sampleimport.getImportStatus(), jobs.DONE)
+        self.assertEqual(sampleimport.getImportCheckpoint(), 2)
+        self.assertEqual(jobs.get_shards(app, sampleimport.UID()), None)
+        barc = getToolByName(self.portal, CATALOG_ANALYSIS_REQUEST_LISTING)
+        self.assertEqual(len(barc(portal_type='AnalysisRequest')), 2)
+
+    def test_failed_shard_job(self):
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        sampleimport = self.create_valid_import()
+        app = self.portal.aq_parent
+
+        def import_row(self, row, memo):
+            raise ValueError("broken row")
+
+        import_row_orig = SampleImport.import_row
+        SampleImport.import_row = import_row
+        settings.DEFAULTS['import_queue'] = 'on'
+        settings.DEFAULTS['import_shards'] = '2'
+        try:
+            workflow.doActionFor(sampleimport, 'import')
+            transaction.commit()
+            job_id, job = jobs.claim_job(app)
+            jobs.run_job(app, job_id, job)
+        finally:
+            SampleImport.import_row = import_row_orig
+            settings.DEFAULTS['import_queue'] = 'off'
+            settings.DEFAULTS['import_shards'] = '1'
+        # The job keeps its claim until it expires and runs again
+        queued = jobs.get_queue(app)[job_id]
+        self.assertEqual(queued['attempts'], 1)
+        self.assertTrue(jobs.is_claimed(queued))
+        self.assertEqual(sampleimport.getImportStatus(), jobs.FAILED)
+        self.assertFalse(sampleimport.can_resume_import())
+        # The shards are kept for a resume
+        shards = jobs.get_shards(app, sampleimport.UID())
+        self.assertEqual(len(shards), 2)
+
+    def test_resume_done_shards(self):
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        sampleimport = self.create_valid_import()
+        app = self.portal.aq_parent
+
+        settings.DEFAULTS['import_queue'] = 'on'
+        settings.DEFAULTS['import_shards'] = '2'
+        try:
+            workflow.doActionFor(sampleimport, 'import')
+            # The worker died after the last shard, before completing
+            jobs.drop_jobs(sampleimport)
+            shards = jobs.get_shards(app, sampleimport.UID())
+            for shard in shards.values():
+                shard.checkpoint = shard.end
+                shard.conflicts = 1
+            sampleimport.setImportStatus(jobs.RUNNING)
+            transaction.commit()
+            self.assertTrue(sampleimport.can_resume_import())
+            sampleimport.resume_import()
+            transaction.commit()
+        finally:
+            settings.DEFAULTS['import_queue'] = 'off'
+            settings.DEFAULTS['import_shards'] = '1'
+        self.assertEqual(jobs.get_jobs(sampleimport), [])
+        self.assertEqual(sampleimport.getImportStatus(), jobs.DONE)
+        self.assertEqual(sampleimport.getImportCheckpoint(), 2)
+        self.assertEqual(sampleimport.getImportConflicts(), 2)
+        self.assertEqual(jobs.get_shards(app, sampleimport.UID()), None)
+        self.assertFalse(sampleimport.can_resume_import())
+
+    def test_threaded_import(self):
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        sampleimport = self.create_valid_import()
+        transaction.commit()
+
+        settings.DEFAULTS['import_threads'] = '2'
+        try:
+            workflow.doActionFor(sampleimport, 'import')
+            shards = jobs.get_shards(self.portal, sampleimport.UID())
+            self.assertEqual(len(shards), 2)
+            self.assertEqual(sampleimport.getImportStatus(), jobs.QUEUED)
+            transaction.commit()
+            for runner in list(jobs.runners):
+                runner.join()
+        finally:
+            settings.DEFAULTS['import_threads'] = '0'
+        transaction.begin()
+        self.assertEqual(sampleimport.getImportStatus(), jobs.DONE)
+        self.assertEqual(sampleimport.getImportCheckpoint(), 2)
+        self.assertEqual(jobs.get_shards(self.portal, sampleimport.UID()),
+                         None)
+        barc = getToolByName(self.portal, CATALOG_ANALYSIS_REQUEST_LISTING)
+        self.assertEqual(len(barc(portal_type='AnalysisRequest')), 2)
+
+    def import_chunk_with_conflicts(self, sampleimport, nr_conflicts):
+        """Import the first row of the SampleImport with an import_row that
+        raises nr_conflicts ConflictErrors first. Returns the progress
+        """
+        calls = []
+
+        def import_row(self, therow, memo):
+            calls.append(therow)
+            if len(calls) <= nr_conflicts:
+                raise ConflictError
+
+        import_row_orig = SampleImport.import_row
+        SampleImport.import_row = import_row
+        settings.DEFAULTS['import_conflict_retries'] = '2'
+        settings.DEFAULTS['import_retry_backoff'] = '0'
+        progress = jobs.ImportProgress(sampleimport)
+        try:
+            sampleimport.import_chunk(
+                sampleimport.getSampleData(), 0, 1, {}, progress)
+        finally:
+            SampleImport.import_row = import_row_orig
+            settings.DEFAULTS['import_conflict_retries'] = '3'
+            settings.DEFAULTS['import_retry_backoff'] = '500'
+        return progress
+
+    def test_chunk_retried_after_conflicts(self):
+        sampleimport = self.create_valid_import()
+        transaction.commit()
+        progress = self.import_chunk_with_conflicts(sampleimport, 2)
+        self.assertEqual(progress.checkpoint, 1)
+        self.assertEqual(progress.conflicts, 2)
+        self.assertEqual(progress.retries, 2)
+
+    def test_chunk_fails_after_retries(self):
+        sampleimport = self.create_valid_import()
+        transaction.commit()
+        self.assertRaises(ConflictError, self.import_chunk_with_conflicts,
+                          sampleimport, 3)
+        # The counters of the failed chunk are committed, its rows are not
+        transaction.abort()
+        self.assertEqual(sampleimport.getImportCheckpoint(), 0)
+        self.assertEqual(sampleimport.getImportConflicts(), 3)
+        self.assertEqual(sampleimport.getImportRetries(), 2)
+
+    def test_resume_import_from_checkpoint(self):
+        sampleimport = self.create_valid_import()
+        # The first row was committed by an earlier, interrupted run
+        sampleimport.setImportCheckpoint(1)
+        transaction.commit()
+
+        settings.DEFAULTS['import_chunk_size'] = '1'
+        try:
+            sampleimport.run_import()
+        finally:
+            settings.DEFAULTS['import_chunk_size'] = '0'
+        self.assertEqual(sampleimport.getImportCheckpoint(), 2)
+        self.assertEqual(sampleimport.getImportStatus(), jobs.DONE)
+        barc = getToolByName(self.portal, CATALOG_ANALYSIS_REQUEST_LISTING)
+        self.assertEqual(len(barc(portal_type='AnalysisRequest')), 1)
+
     def test_LIMS_2080_correctly_interpret_false_and_blank_values(self):
         client = self.portal.clients.objectValues()[0]
         sampleimport = self.addthing(client, 'SampleImport')
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import unittest
+
+from senaite.sampleimporter.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    """Test the size bounded LRU cache
+    """
+
+    def test_hits_and_misses(self):
+        cache = LRUCache(100)
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 'A', 10)
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.get('a'), 'A')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 10)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(30)
+        cache.set('a', 'A', 10)
+        cache.set('b', 'B', 10)
+        cache.set('c', 'C', 10)
+        # Touch 'a', so 'b' is the least recently used
+        cache.get('a')
+        cache.set('d', 'D', 10)
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertEqual(cache.size, 30)
+
+    def test_entry_larger_than_budget_is_not_stored(self):
+        cache = LRUCache(30)
+        cache.set('a', 'A', 10)
+        cache.set('b', 'B', 40)
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+
+    def test_replace_entry(self):
+        cache = LRUCache(30)
+        cache.set('a', 'A', 10)
+        cache.set('a', 'AA', 20)
+        self.assertEqual(cache.get('a'), 'AA')
+        self.assertEqual(cache.size, 20)
+        self.assertEqual(len(cache), 1)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestLRUCache))
+    return suite
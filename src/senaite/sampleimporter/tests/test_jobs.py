@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import threading
+import time
+import unittest
+
+import transaction
+from BTrees.OOBTree import OOBTree
+from persistent.mapping import PersistentMapping
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from senaite.sampleimporter.jobs import ImportShard
+from senaite.sampleimporter.jobs import LeaseKeeper
+from senaite.sampleimporter.jobs import QUEUE_KEY
+from senaite.sampleimporter.jobs import claim_job
+from senaite.sampleimporter.jobs import split_rows
+
+NR_JOBS = 20
+
+
+class TestSplitRows(unittest.TestCase):
+
+    def test_even(self):
+        self.assertEqual(split_rows(6, 3), [(0, 2), (2, 4), (4, 6)])
+
+    def test_rest(self):
+        self.assertEqual(split_rows(7, 3), [(0, 3), (3, 5), (5, 7)])
+
+    def test_more_shards_than_rows(self):
+        self.assertEqual(split_rows(2, 4), [(0, 1), (1, 2)])
+
+    def test_shard_done(self):
+        shard = ImportShard('uid', 0, 10, 20)
+        self.assertFalse(shard.done)
+        shard.checkpoint = 20
+        self.assertTrue(shard.done)
+
+
+class TestClaimShards(unittest.TestCase):
+    """Workers on two clients of the same database claim the shard jobs of
+    an import. Every connection stands for a ZEO client: it has its own
+    cache and transactions, and sees the commits of the others at
+    transaction boundaries
+    """
+
+    def setUp(self):
+        self.db = DB(MappingStorage())
+        connection = self.db.open()
+        root = connection.root()
+        root['Application'] = PersistentMapping()
+        queue = root[QUEUE_KEY] = OOBTree()
+        for nr in range(NR_JOBS):
+            queue['job-{:02d}'.format(nr)] = {'uid': 'uid', 'shard': nr}
+        transaction.commit()
+        connection.close()
+
+    def tearDown(self):
+        self.db.close()
+
+    def claim_all(self, claimed):
+        connection = self.db.open()
+        try:
+            app = connection.root()['Application']
+            while True:
+                job = claim_job(app)
+                if job is None:
+                    break
+                claimed.append(job[0])
+        finally:
+            transaction.abort()
+            connection.close()
+
+    def test_claim_conflict(self):
+        connection = self.db.open()
+        app = connection.root()['Application']
+        # Load the queue before the other client claims the first job
+        self.assertEqual(len(connection.root()[QUEUE_KEY]), NR_JOBS)
+
+        manager = transaction.TransactionManager()
+        other = self.db.open(transaction_manager=manager)
+        queue = other.root()[QUEUE_KEY]
+        queue['job-00'] = dict(queue['job-00'], claimed=1e12)
+        manager.commit()
+        other.close()
+
+        try:
+            job_id, job = claim_job(app)
+        finally:
+            transaction.abort()
+            connection.close()
+        self.assertEqual(job_id, 'job-01')
+        self.assertEqual(job['shard'], 1)
+
+    def test_claim_job_id(self):
+        connection = self.db.open()
+        app = connection.root()['Application']
+        try:
+            job_id, job = claim_job(app, 'job-05')
+            self.assertEqual(job['shard'], 5)
+            self.assertEqual(claim_job(app, 'job-05'), None)
+            self.assertEqual(claim_job(app, 'job-99'), None)
+        finally:
+            transaction.abort()
+            connection.close()
+
+    def test_lease_keeper(self):
+        connection = self.db.open()
+        app = connection.root()['Application']
+        try:
+            job_id, job = claim_job(app)
+            claimed = connection.root()[QUEUE_KEY][job_id]['claimed']
+        finally:
+            transaction.abort()
+            connection.close()
+        lease = LeaseKeeper(self.db, job_id)
+        lease.interval = 0.01
+        lease.start()
+        time.sleep(0.1)
+        lease.stop()
+
+        connection = self.db.open()
+        try:
+            renewed = connection.root()[QUEUE_KEY][job_id]['claimed']
+        finally:
+            connection.close()
+        self.assertTrue(renewed > claimed)
+
+    def test_two_clients(self):
+        results = ([], [])
+        threads = [threading.Thread(target=self.claim_all, args=(claimed,))
+                   for claimed in results]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        first, second = map(set, results)
+        self.assertEqual(len(first) + len(second), NR_JOBS)
+        self.assertFalse(first & second)
+        self.assertEqual(first | second,
+                         set('job-{:02d}'.format(nr) for nr in range(NR_JOBS)))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestSplitRows))
+    suite.addTest(makeSuite(TestClaimShards))
+    return suite
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import unittest
+
+from senaite.sampleimporter.munge import detect_date_format
+from senaite.sampleimporter.munge import munge_cell
+from senaite.sampleimporter.munge import munge_columns
+
+
+class TestMunge(unittest.TestCase):
+    """Test the conversion of sample columns into field values
+    """
+
+    def test_munge_cell(self):
+        self.assertEqual(munge_cell('boolean', 'No'), ('', True))
+        self.assertEqual(munge_cell('boolean', 'x'), ('1', True))
+        self.assertEqual(munge_cell('string', 'abc'), ('abc', True))
+        value, valid = munge_cell('datetime', '2019-03-01')
+        self.assertTrue(valid)
+        self.assertEqual(value.year(), 2019)
+        self.assertEqual(munge_cell('datetime', 'not a date'), (None, False))
+
+    def test_detect_date_format(self):
+        self.assertEqual(detect_date_format(['', '2019-03-01 10:30']),
+                         '%Y-%m-%d %H:%M')
+        self.assertEqual(detect_date_format(['1 March 2019']), None)
+        self.assertEqual(detect_date_format(['']), None)
+
+    def test_fixed_format_matches_guesser(self):
+        for value, date_format in (
+                ('2019-03-01', '%Y-%m-%d'),
+                ('2019-07-01 10:30', '%Y-%m-%d %H:%M'),
+                ('2019-03-01T10:30:15', '%Y-%m-%dT%H:%M:%S'),
+                ('2019/03/01', '%Y/%m/%d'),
+                ('2019/07/01 10:30:15', '%Y/%m/%d %H:%M:%S')):
+            fixed, valid = munge_cell('datetime', value, date_format)
+            guessed, valid = munge_cell('datetime', value)
+            self.assertEqual(fixed.timeTime(), guessed.timeTime(), value)
+            self.assertEqual(fixed.tzoffset(), guessed.tzoffset(), value)
+
+    def test_equal_dates_are_parsed_once(self):
+        munged = munge_columns([('datetime', ['2019-03-01', '2019-03-01'])])
+        self.assertTrue(munged[0][0][0] is munged[0][1][0])
+
+    def test_empty_cells(self):
+        munged = munge_columns([('string', ['a', '', None])])
+        self.assertEqual(munged, [[('a', True), None, None]])
+
+    def test_processes_keep_row_order(self):
+        columns = [
+            ('boolean', [str(i % 2) for i in range(25)]),
+            ('string', [str(i) for i in range(25)]),
+        ]
+        serial = munge_columns(columns)
+        pooled = munge_columns(columns, processes=2, chunk_size=4)
+        self.assertEqual(pooled, serial)
+        self.assertEqual(pooled[1][24], ('24', True))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestMunge))
+    return suite
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import csv
+import os
+import unittest
+from StringIO import StringIO
+from zipfile import ZipFile
+
+from senaite.sampleimporter.document import AR_FIELD
+from senaite.sampleimporter.document import ColumnPlan
+from senaite.sampleimporter.document import KEYWORD
+from senaite.sampleimporter.document import SAMPLE_ID
+from senaite.sampleimporter.document import UNEXPECTED
+from senaite.sampleimporter.document import parse_rows
+from senaite.sampleimporter.reader import READ_ERRORS
+from senaite.sampleimporter.reader import gzip_file
+from senaite.sampleimporter.reader import is_compressed
+from senaite.sampleimporter.reader import iter_lines
+from senaite.sampleimporter.reader import iter_rows
+from senaite.sampleimporter.reader import open_mapped
+
+FILES = os.path.join(os.path.dirname(__file__), 'files')
+
+
+def get_path(filename):
+    return os.path.join(FILES, filename)
+
+
+def trim(row):
+    """Strip the trailing empty cells, spreadsheets do not store them
+    """
+    row = list(row)
+    while row and not row[-1]:
+        row.pop()
+    return row
+
+
+class TestReader(unittest.TestCase):
+    """Test the import file readers
+    """
+
+    def setUp(self):
+        with open(get_path('SampleImportTemplate.csv'), 'rb') as fileobj:
+            self.data = fileobj.read()
+        self.rows = list(csv.reader(self.data.splitlines()))
+
+    def test_iter_lines_matches_splitlines(self):
+        for data in (self.data,
+                     self.data.replace('\n', '\r\n'),
+                     self.data.replace('\n', '\r')):
+            for chunk_size in (1, 2, 7, 1024):
+                lines = list(iter_lines(StringIO(data), chunk_size))
+                self.assertEqual(lines, data.splitlines())
+
+    def test_csv_rows(self):
+        rows = list(iter_rows(StringIO(self.data)))
+        self.assertEqual(rows, self.rows)
+
+    def test_mapped_csv_rows(self):
+        with open_mapped(get_path('SampleImportTemplate.csv')) as fileobj:
+            rows = list(iter_rows(fileobj))
+        self.assertEqual(rows, self.rows)
+
+    def test_workbook_rows(self):
+        expected = map(trim, self.rows)
+        for filename in ('SampleImportTemplate.xlsx',
+                         'SampleImportTemplate.ods'):
+            with open_mapped(get_path(filename)) as fileobj:
+                rows = map(trim, iter_rows(fileobj))
+            self.assertEqual(rows, expected, filename)
+
+    def test_gzip_rows(self):
+        compressed = gzip_file(StringIO(self.data))
+        self.assertTrue(is_compressed(compressed))
+        self.assertEqual(list(iter_rows(compressed)), self.rows)
+
+    def test_gzip_workbook_rows(self):
+        expected = map(trim, self.rows)
+        for filename in ('SampleImportTemplate.xlsx',
+                         'SampleImportTemplate.ods'):
+            with open(get_path(filename), 'rb') as fileobj:
+                compressed = gzip_file(fileobj)
+            rows = map(trim, iter_rows(compressed))
+            self.assertEqual(rows, expected, filename)
+
+    def test_zip_rows(self):
+        archive = StringIO()
+        with ZipFile(archive, 'w') as zipfile:
+            zipfile.writestr('SampleImportTemplate.csv', self.data)
+        archive.seek(0)
+        self.assertTrue(is_compressed(archive))
+        self.assertEqual(list(iter_rows(archive)), self.rows)
+
+    def test_corrupt_files(self):
+        with open(get_path('SampleImportTemplate.xlsx'), 'rb') as fileobj:
+            workbook = ZipFile(fileobj)
+            corrupt = StringIO()
+            with ZipFile(corrupt, 'w') as zipfile:
+                for name in workbook.namelist():
+                    data = workbook.read(name)
+                    if name.startswith('xl/worksheets/'):
+                        data = data[:len(data) // 2]
+                    zipfile.writestr(name, data)
+        compressed = gzip_file(StringIO(self.data)).read()
+        for data in ('PK\x03\x04' + 'x' * 100,
+                     compressed[:len(compressed) // 2],
+                     '\x1f\x8b' + 'x' * 100,
+                     corrupt.getvalue()):
+            with self.assertRaises(READ_ERRORS):
+                list(iter_rows(StringIO(data)))
+
+    def test_parse_rows(self):
+        document = parse_rows(self.rows)
+        self.assertEqual(document.header_data[:3],
+                         ['SampleImportTemplate', 'Happy Hills', 'HH'])
+        self.assertEqual(document.batch_data[0], 'Happy Hills Survey 13')
+        self.assertEqual(document.nr_samples, 10)
+        row = document.samples[0]
+        self.assertEqual(row['Samples'], 'Sample 1')
+        self.assertEqual(row['SampleType'], 'Canola')
+        self.assertEqual(dict(row.items()),
+                         dict(zip(document.sample_headers,
+                                  [x.strip() for x in self.rows[6]])))
+
+    def test_column_plan(self):
+        document = parse_rows(self.rows)
+        plan = ColumnPlan(document.samples,
+                          ar_fields=set(['ClientSampleID', 'SampleType']),
+                          keywords=set(['Ca', 'Cu']),
+                          profiles=set())
+        self.assertEqual(plan.get_headers(AR_FIELD),
+                         ['ClientSampleID', 'SampleType'])
+        self.assertEqual(plan.get_headers(KEYWORD), ['Ca', 'Cu'])
+        self.assertIn('Price excl Tax', plan.get_headers(UNEXPECTED))
+        self.assertEqual(plan.get_cells(SAMPLE_ID)[1], 'Sample 2')
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestReader))
+    return suite
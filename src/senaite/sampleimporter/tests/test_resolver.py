@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import unittest
+
+from senaite.sampleimporter import resolver
+from senaite.sampleimporter.resolver import ReferenceResolver
+
+
+class Brain(object):
+
+    def __init__(self, portal_type, uid, title):
+        self.portal_type, self.UID, self.Title = portal_type, uid, title
+
+
+class Index(object):
+    meta_type = 'FieldIndex'
+
+
+class Catalog(object):
+    """Catalog that answers portal_type, UID and Title queries, and records
+    them
+    """
+
+    def __init__(self, brains):
+        self.brains = brains
+        self.queries = []
+        self._catalog = self
+        self.indexes = {'Title': Index()}
+
+    def __call__(self, portal_type, UID=None, Title=None):
+        self.queries.append((portal_type, UID or Title))
+        return [b for b in self.brains if b.portal_type == portal_type and
+                (UID is None or b.UID in UID) and
+                (Title is None or b.Title in Title)]
+
+
+class Context(object):
+
+    def lookup(self, allowed_types, **kwargs):
+        return []
+
+
+class TestReferenceResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = Catalog([
+            Brain('SampleType', 'uid-water', 'Water'),
+            Brain('SampleType', 'uid-soil', 'Soil'),
+            Brain('SamplePoint', 'uid-river', 'River'),
+            Brain('Batch', 'uid-b1', 'B-001'),
+            Brain('Batch', 'uid-b2', 'B-002'),
+        ])
+        self.get_catalog = resolver.get_catalog
+        self.get_catalog_id = resolver.get_catalog_id
+        resolver.get_catalog = lambda context, portal_type: self.catalog
+        resolver.get_catalog_id = lambda context, portal_type: (
+            portal_type == 'Batch' and 'bika_catalog' or 'bika_setup_catalog')
+        self.resolver = ReferenceResolver(Context())
+
+    def tearDown(self):
+        resolver.get_catalog = self.get_catalog
+        resolver.get_catalog_id = self.get_catalog_id
+
+    def test_resolve_title_and_uid(self):
+        types = ('SampleType',)
+        self.assertEqual(self.resolver.resolve(types, 'Water'),
+                         ['uid-water'])
+        self.assertEqual(self.resolver.resolve(types, 'uid-soil'),
+                         ['uid-soil'])
+        self.assertEqual(self.resolver.resolve(types, 'Air'), [])
+        self.assertEqual(self.resolver.queries, 2)
+
+    def test_prefetched_uids(self):
+        types = ('SampleType', 'SamplePoint')
+        self.resolver.prefetch_uids(types, ['uid-water', 'uid-river', 'bad'])
+        self.assertEqual(self.resolver.by_uid(types, 'uid-water'),
+                         ['uid-water'])
+        self.assertEqual(self.resolver.by_uid(types, 'uid-river'),
+                         ['uid-river'])
+        self.assertEqual(self.resolver.by_uid(types, 'bad'), [])
+        # Only the UID queries, no type was loaded
+        self.assertEqual(self.resolver.queries, 2)
+        self.assertTrue(all(uids for portal_type, uids
+                            in self.catalog.queries))
+
+    def test_uid_not_prefetched(self):
+        types = ('SampleType',)
+        self.resolver.prefetch_uids(types, ['uid-water'])
+        self.assertEqual(self.resolver.by_uid(types, 'uid-soil'),
+                         ['uid-soil'])
+        self.assertEqual(self.catalog.queries[-1], ('SampleType', None))
+
+    def test_prefetch_setup_type(self):
+        types = ('SampleType',)
+        self.resolver.prefetch(types, ['Water', 'uid-soil'])
+        self.assertEqual(self.catalog.queries, [('SampleType', None)])
+        self.assertEqual(self.resolver.resolve(types, 'uid-soil'),
+                         ['uid-soil'])
+
+    def test_prefetch_queries_values(self):
+        types = ('Batch',)
+        self.resolver.prefetch(types, ['B-001', 'uid-b2', 'B-001'])
+        # One Title and one UID query, the Batches were not loaded
+        self.assertEqual(len(self.catalog.queries), 2)
+        self.assertTrue(all(values for portal_type, values
+                            in self.catalog.queries))
+        self.assertEqual(self.resolver.resolve(types, 'B-001'), ['uid-b1'])
+        self.assertEqual(self.resolver.resolve(types, 'uid-b2'), ['uid-b2'])
+        self.assertEqual(len(self.catalog.queries), 2)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestReferenceResolver))
+    return suite
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import unittest
+
+import transaction
+from persistent import Persistent
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from senaite.sampleimporter import services
+from senaite.sampleimporter.services import ServiceIndex
+from senaite.sampleimporter.services import get_service_index
+from senaite.sampleimporter.services import invalidate_service_indexes
+from senaite.sampleimporter.services import object_changed
+
+
+class Service(object):
+
+    def __init__(self, uid, keyword, title):
+        self.uid, self.keyword, self.title = uid, keyword, title
+
+    def UID(self):
+        return self.uid
+
+    def getKeyword(self):
+        return self.keyword
+
+    def Title(self):
+        return self.title
+
+
+class Profile(object):
+
+    def __init__(self, uid, key, title, services):
+        self.uid, self.key, self.title = uid, key, title
+        self.services = services
+
+    def UID(self):
+        return self.uid
+
+    def getProfileKey(self):
+        return self.key
+
+    def Title(self):
+        return self.title
+
+    def getService(self):
+        return self.services
+
+
+class TestServiceIndex(unittest.TestCase):
+    """Test the in-memory index of services and profiles
+    """
+
+    def setUp(self):
+        self.cu = Service('uid-cu', 'Cu', 'Copper')
+        self.fe = Service('uid-fe', 'Fe', 'Iron')
+        self.index = ServiceIndex()
+        self.index.add_service(self.cu)
+        self.index.add_service(self.fe)
+        self.index.add_profile(
+            Profile('uid-metals', 'MET', 'Metals', [self.cu, self.fe]))
+
+    def test_service_tokens(self):
+        for token in ('Cu', 'Copper', 'uid-cu'):
+            self.assertEqual(self.index.get_service_uid(token), 'uid-cu')
+        self.assertEqual(self.index.get_service_uid('Zn'), None)
+
+    def test_profile_tokens(self):
+        for token in ('MET', 'Metals', 'uid-metals'):
+            self.assertEqual(self.index.get_services_of_profile(token),
+                             frozenset(['uid-cu', 'uid-fe']))
+        self.assertTrue('Metals' in self.index.profile_tokens)
+        self.assertEqual(self.index.get_services_of_profile('Salts'), None)
+
+
+class Site(Persistent):
+
+    def getPhysicalPath(self):
+        return ('', 'site')
+
+
+class Brain(object):
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def getObject(self):
+        return self.obj
+
+
+class TestServiceIndexVersion(unittest.TestCase):
+    """The index is built again after a committed change of a service, on
+    any connection, but not after an aborted one
+    """
+
+    def setUp(self):
+        self.services = [Service('uid-cu', 'Cu', 'Copper')]
+        self.queries = 0
+        self.get_portal = services.get_portal
+        self.get_catalog = services.get_catalog
+        services.get_portal = lambda context: context
+        services.get_catalog = lambda context, portal_type: self.catalog
+        invalidate_service_indexes()
+        self.db = DB(MappingStorage())
+        connection = self.db.open()
+        connection.root()['site'] = Site()
+        transaction.commit()
+        connection.close()
+        self.connection = self.db.open()
+        self.site = self.connection.root()['site']
+
+    def tearDown(self):
+        transaction.abort()
+        self.connection.close()
+        self.db.close()
+        services.get_portal = self.get_portal
+        services.get_catalog = self.get_catalog
+        invalidate_service_indexes()
+
+    def catalog(self, portal_type):
+        self.queries += 1
+        if portal_type == 'AnalysisService':
+            return [Brain(service) for service in self.services]
+        return []
+
+    def test_index_is_kept(self):
+        index = get_service_index(self.site)
+        self.assertTrue(get_service_index(self.site) is index)
+        self.assertEqual(self.queries, 2)
+
+    def test_aborted_change(self):
+        index = get_service_index(self.site)
+        self.services.append(Service('uid-fe', 'Fe', 'Iron'))
+        object_changed(self.site, None)
+        self.assertTrue(get_service_index(self.site).is_keyword('Fe'))
+        transaction.abort()
+        self.services.pop()
+        self.assertTrue(get_service_index(self.site) is index)
+
+    def test_change_on_other_connection(self):
+        index = get_service_index(self.site)
+        self.services.append(Service('uid-fe', 'Fe', 'Iron'))
+        manager = transaction.TransactionManager()
+        other = self.db.open(transaction_manager=manager)
+        object_changed(other.root()['site'], None)
+        manager.commit()
+        other.close()
+        transaction.begin()
+        changed = get_service_index(self.site)
+        self.assertFalse(changed is index)
+        self.assertTrue(changed.is_keyword('Fe'))
+        self.assertTrue(get_service_index(self.site) is changed)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestServiceIndex))
+    suite.addTest(makeSuite(TestServiceIndexVersion))
+    return suite
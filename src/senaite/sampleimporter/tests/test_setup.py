@@ -20,6 +20,7 @@
 
 from senaite.sampleimporter import PRODUCT_NAME
 from senaite.sampleimporter.tests.base import SimpleTestCase
+from senaite.sampleimporter.upgrade.v01_00_002 import upgrade
 
 
 class TestSetup(SimpleTestCase):
@@ -34,6 +35,13 @@ class TestSetup(SimpleTestCase):
         qi = self.portal.portal_quickinstaller
         self.assertTrue(qi.isProductInstalled(PRODUCT_NAME))
 
+    def test_upgrade_adds_indexes(self):
+        catalog = self.portal.portal_catalog
+        catalog.delIndex('getClientOrderNumber')
+        upgrade(self.portal.portal_setup)
+        self.assertTrue('getClientOrderNumber' in catalog.indexes())
+        self.assertTrue('getClientReference' in catalog.indexes())
+
 
 def test_suite():
     from unittest import TestSuite, makeSuite
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+from senaite.sampleimporter import PRODUCT_NAME
+from senaite.sampleimporter import PROFILE_ID
+from senaite.sampleimporter import logger
+from senaite.sampleimporter.setuphandlers import setup_catalogs
+
+version = "1.0.2"
+
+
+def upgrade(tool):
+    """Add the catalog indexes of the uniqueness checks of SampleImport
+    header values, which were only added on install, and the Resume import
+    action of SampleImport
+    """
+    portal = tool.aq_inner.aq_parent
+    logger.info("Upgrading {} to {} [BEGIN]".format(
+        PRODUCT_NAME.upper(), version))
+    setup_catalogs(portal)
+    tool.runImportStepFromProfile(PROFILE_ID, 'typeinfo')
+    logger.info("Upgrading {} to {} [DONE]".format(
+        PRODUCT_NAME.upper(), version))
+    return True